@@ -1,12 +1,25 @@
 from agno.agent import Agent
-from agno.models.openai import OpenAIChat
 from agno.tools.sql import SQLTools
 
 from agno.tools.exa import ExaTools
 from agno.tools.file import FileTools  # Import FileTools for saving reports
 from datetime import datetime
+import contextvars
 import json
 import os
+import re
+import shutil
+import sqlite3
+import uuid
+
+from incident_shards import SHARD_DIR, fetch_incidents, load_manifest, search_incidents
+from incident_summary import COMPACT_COLUMNS
+from model_scheduler import ScheduledOpenAIChat, call_priority, configure_scheduler
+from report_context import (
+    INCIDENT_PLACEHOLDER_PATTERN, WEB_RESULTS_PLACEHOLDER, expand_report_placeholders, pack_report_context
+)
+from report_store import SOURCE_DB, SOURCE_WEB, find_reports, get_report, store_report
+from ticket_profiler import profile_ticket
 
 def read_file_with_fallback_encoding(file_path):
     """
@@ -28,6 +41,8 @@ def read_file_with_fallback_encoding(file_path):
         Exception: For other errors while reading the file
     """
     encodings = ['utf-8', 'cp932', 'shift_jis', 'latin1']
+    # 一時ファイルは処理中のチケットの一時ディレクトリから読み込む
+    file_path = ticket_path(file_path)
     
     # For JSON files, use binary mode first to check if it's a binary JSON file
     if file_path.lower().endswith('.json'):
@@ -76,6 +91,8 @@ def read_file_with_fallback_encoding(file_path):
 # OpenAI API key（実際のキーに置き換えてください）
 api_key = "sk-xxxxxxxxxxx"
 exa_api_key="xxxxxxxxxx"
+# 全エージェントのモデル呼び出しで共有するレート制限（利用中のAPIプランの上限に合わせて変更してください）
+configure_scheduler(requests_per_minute=500, tokens_per_minute=200000)
 # 今日の日付を取得（Exaの検索時に使用）
 today = datetime.now().strftime("%Y-%m-%d")
 
@@ -89,22 +106,209 @@ QUERY_FILE = os.path.join(TEMP_DIR, "original_query.txt")
 SQL_RESULTS_FILE = os.path.join(TEMP_DIR, "sql_results.json")
 WEB_RESULTS_FILE = os.path.join(TEMP_DIR, "web_results.json")
 SQL_QUERY_FILE = os.path.join(TEMP_DIR, "generated_sql_query.txt")
+# インシデントデータベースのパス
+INCIDENT_DB = ".db/it_support.db"
+# レポートを圧縮して保存するレポートストア（report_store.py）
+REPORT_DB_FILE = os.path.join(REPORTS_DIR, "reports.db")
+# チケットごとのプロファイル（ticket_profiler.py）の保存先
+PROFILE_DIR = os.path.join(REPORTS_DIR, "profiles")
+
+# 処理中のチケットID（キュー経由で実行する場合にレポートをチケットIDで保存するため）
+_current_ticket_id = contextvars.ContextVar("current_ticket_id", default=None)
+
+# 処理中のチケットの一時ディレクトリ。同じマシンで複数のワーカーが動作しても一時ファイルが衝突しないよう、
+# process_ticket() ではチケットごとに temp_files/<チケットID>/ を使用する
+_current_temp_dir = contextvars.ContextVar("current_temp_dir", default=TEMP_DIR)
+
+
+def ticket_temp_dir(ticket_id):
+    """チケットの一時ディレクトリのパスを返す"""
+    return os.path.join(TEMP_DIR, re.sub(r"[^0-9A-Za-z_\-]+", "_", str(ticket_id)))
+
+
+def ticket_path(file_path):
+    """
+    一時ディレクトリ（TEMP_DIR）内のファイルのパスを、処理中のチケットの一時ディレクトリ内のパスに読み替える。
+    エージェントの指示には既定のパス（QUERY_FILE など）を記載し、ファイルの読み書き時にこの関数で読み替える。
+    """
+    temp_dir = _current_temp_dir.get()
+    path = os.path.abspath(file_path)
+    try:
+        if os.path.commonpath([path, TEMP_DIR]) != TEMP_DIR or os.path.commonpath([path, temp_dir]) == temp_dir:
+            return file_path
+    except ValueError:
+        # ドライブが異なる場合（Windows）
+        return file_path
+    return os.path.join(temp_dir, os.path.relpath(path, TEMP_DIR))
+
+# レポート生成エージェントに渡すコンテキストのトークン予算
+REPORT_CONTEXT_TOKEN_BUDGET = 6000
+
+
+def _read_optional(file_path, default):
+    """ファイルが存在しない場合はデフォルト値を返し、存在する場合はフォールバック付きで読み込む"""
+    if not os.path.exists(file_path):
+        return default
+    return read_file_with_fallback_encoding(file_path)
+
+
+def _load_web_briefing():
+    web_results = _read_optional(ticket_path(WEB_RESULTS_FILE), "")
+    if isinstance(web_results, str):
+        return web_results
+    # 空の配列などJSONとして保存された場合
+    return json.dumps(web_results, ensure_ascii=False, indent=2) if web_results else ""
+
+
+def _load_sql_rows():
+    rows = _read_optional(ticket_path(SQL_RESULTS_FILE), [])
+    return rows if isinstance(rows, list) else []
+
+
+def load_report_context():
+    """
+    元の問い合わせ内容、データベース検索結果、Web検索結果を読み込み、
+    トークン予算内に収まるよう関連度順に整理したレポート作成用のコンテキストを返す。
+
+    Returns:
+        str: レポート作成用のコンテキスト（省略した情報の一覧を含む）
+    """
+    query = _read_optional(ticket_path(QUERY_FILE), "")
+    return pack_report_context(
+        query if isinstance(query, str) else str(query),
+        _load_sql_rows(),
+        _load_web_briefing(),
+        REPORT_CONTEXT_TOKEN_BUDGET,
+    )
+
+
+def _load_full_incidents(incident_numbers):
+    """インシデント番号を指定して、全フィールドのレコードをデータベースから読み込む"""
+    incident_numbers = list(dict.fromkeys(incident_numbers))
+    if not incident_numbers:
+        return []
+    if USE_INCIDENT_SHARDS:
+        return fetch_incidents(incident_numbers)
+    conn = sqlite3.connect(INCIDENT_DB)
+    conn.row_factory = sqlite3.Row
+    try:
+        placeholders = ", ".join("?" for _ in incident_numbers)
+        return [dict(row) for row in conn.execute(
+            f"SELECT * FROM incidents WHERE incident_number IN ({placeholders})", incident_numbers
+        )]
+    finally:
+        conn.close()
+
+
+def load_incident_details(incident_numbers):
+    """
+    レポートで引用するインシデントの全フィールド（description, resolution の全文を含む）を読み込む。
+    検索結果にはコンパクトな要約しか含まれないため、解決策を正確に引用する場合に使用する。
+
+    Args:
+        incident_numbers (str): カンマ区切りのインシデント番号（例: "INC00008, INC00012"）
+
+    Returns:
+        str: 各レコードのJSON
+    """
+    rows = _load_full_incidents(n.strip() for n in re.split(r"[,、\s]+", incident_numbers) if n.strip())
+    return json.dumps(rows, ensure_ascii=False, indent=2)
+
+
+def save_report(contents, keywords):
+    """
+    レポートのプレースホルダーを完全なデータに展開し、レポートストアに保存する。
+    - {{INCIDENT_DETAILS:インシデント番号}} はデータベースの該当レコードの全フィールドの表に置き換えられる
+    - {{WEB_RESULTS}} はWeb検索結果の全文に置き換えられる
+    レポートは日付・キーワード・引用したインシデント番号・情報源（DB/Web）で索引付けされ、
+    同じ内容のレポートが既にある場合は重複して保存しない。
+
+    Args:
+        contents (str): Markdown形式のレポート本文
+        keywords (str): 索引に登録するカンマ区切りのキーワード（例: "BenefitAccrual, 給与計算"）
+
+    Returns:
+        str: 保存結果（レポートID）
+    """
+    source = SOURCE_WEB if WEB_RESULTS_PLACEHOLDER in contents else SOURCE_DB
+    # 引用したレコードのみ、全フィールドをデータベースから読み込んで展開する
+    cited = _load_full_incidents(INCIDENT_PLACEHOLDER_PATTERN.findall(contents))
+    contents = expand_report_placeholders(contents, cited, _load_web_briefing())
+    report_id, created = store_report(
+        contents, keywords, source, incident_numbers=[row["incident_number"] for row in cited],
+        ticket_id=_current_ticket_id.get(), db_path=REPORT_DB_FILE,
+    )
+    if not created:
+        return f"同じ内容のレポートが既に保存されています（レポートID: {report_id}）"
+    return f"レポートを保存しました（レポートID: {report_id}）"
+
 
 # SQLite DBへの接続を設定
 sql_tools = SQLTools(
-    db_url="sqlite:///.db/it_support.db",  # SQLiteデータベースのパス
+    db_url=f"sqlite:///{INCIDENT_DB}",  # SQLiteデータベースのパス
     list_tables=True,
     describe_table=True,
     run_sql_query=True
 )
 
+class TicketFileTools(FileTools):
+    """一時ファイルのパスを処理中のチケットの一時ディレクトリ内のパスに読み替える FileTools"""
+
+    def save_file(self, contents: str, file_name: str, overwrite: bool = True) -> str:
+        return super().save_file(contents, ticket_path(str(self.base_dir.joinpath(file_name))), overwrite)
+
+    def read_file(self, file_name: str) -> str:
+        return super().read_file(ticket_path(str(self.base_dir.joinpath(file_name))))
+
+    # ツールの説明としてモデルに渡されるため、元のdocstringを使用する
+    save_file.__doc__ = FileTools.save_file.__doc__
+    read_file.__doc__ = FileTools.read_file.__doc__
+
+
 # ファイル操作用のツールを設定
-file_tools = FileTools()
+file_tools = TicketFileTools()
+
+# シャード化されたインシデントストア（python incident_shards.py で作成）があれば、シャード横断検索を使用する
+USE_INCIDENT_SHARDS = load_manifest(SHARD_DIR) is not None
+
+
+def search_incident_shards(keywords):
+    """
+    システム名・作成月ごとに分割されたインシデントのシャードを並列に検索し、
+    スコアの高い上位5件を検索結果ファイルに保存する。
+    キーワードにシステム名が含まれる場合は、そのシステムのシャードのみを検索する。
+
+    Args:
+        keywords (str): Keyword Extractorが出力したカンマ区切りのキーワード
+
+    Returns:
+        str: 検索結果の件数と各レコードのJSON
+    """
+    rows = search_incidents(re.split(r"[,、]", keywords), limit=5)
+    with open(ticket_path(SQL_RESULTS_FILE), "w", encoding="utf-8") as f:
+        json.dump(rows, f, ensure_ascii=False, indent=2)
+    return f"検索結果: {len(rows)}件\n" + json.dumps(rows, ensure_ascii=False, indent=2)
+
+
+if USE_INCIDENT_SHARDS:
+    sql_execution_steps = f"""
+    1. Keyword Extractorが出力したキーワードをカンマ区切りのまま search_incident_shards(keywords=...) に渡して検索する
+    2. 検索結果の件数を表示する
+    3. 検索結果は search_incident_shards が "{SQL_RESULTS_FILE}" に自動で保存するため、ファイル保存は不要"""
+    sql_executor_tools = [search_incident_shards]
+    sql_search_instruction = "2. SQL Query Executorにキーワードを渡してシャード化されたDBを検索する（SQL Query Generatorは実行しない）"
+else:
+    sql_execution_steps = f"""
+    1. '{SQL_QUERY_FILE}'から実行するSQLを読み込んだ後、SQLToolsを使用してデータベースにクエリを実行する
+    2. 検索結果の件数を表示する
+    3. 取得した各レコードの完全な情報をfile_toolsを使ってローカルフォルダ内に保存する"""
+    sql_executor_tools = [sql_tools, file_tools]
+    sql_search_instruction = "2. SQL Query Generatorでキーワードを基にSQLクエリを生成し、SQL Query Executorを実行してDBを検索する"
 
 # キーワード抽出エージェント
 keyword_agent = Agent(
     name="Keyword Extractor",
-    model=OpenAIChat("gpt-4o-mini", api_key=api_key),
+    model=ScheduledOpenAIChat("gpt-4o-mini", api_key=api_key),
     role="""
     あなたの役割は、ITシステムの問い合わせからデータベース検索に適した重要なキーワードを抽出することです。
     
@@ -129,12 +333,12 @@ keyword_agent = Agent(
 # SQLクエリー提案エージェント
 sql_query_agent = Agent(
     name="SQL Query Generator",
-    model=OpenAIChat("gpt-4o-mini", api_key=api_key),
+    model=ScheduledOpenAIChat("gpt-4o-mini", api_key=api_key),
     role=f"""
     あなたの役割は、Keyword Extractorが出力したキーワードを使用してSQLiteデータベース向けの効果的な検索クエリーを作成することです。
 
     データベース構造:
-    テーブル名: incidents
+    テーブル名: incidents (別名 i)
     主要カラム:
     - incident_number: インシデント番号
     - system_name: システム名 (SAP ERP, Oracle EBS, Microsoft Dynamics 365, Infor CloudSuite, Salesforce)
@@ -145,11 +349,35 @@ sql_query_agent = Agent(
     - error_code: エラーコード
     - affected_version: 影響バージョン
 
+    テーブル名: incident_summaries (別名 s) - インシデントごとのコンパクトな要約
+    主要カラム:
+    - incident_number: インシデント番号
+    - error_codes: 説明文から抽出したエラーコード
+    - symptoms: 主な症状
+    - resolution_gist: 解決策の要点
+
+    テーブル名: incident_clusters (別名 c) - ほぼ同じ内容のインシデントのクラスタ
+    主要カラム:
+    - incident_number: インシデント番号
+    - cluster_id: クラスタID（同じ値のインシデントはほぼ同じ内容）
+
     入力されたキーワードだけを使い、以下の条件を満たすSQLiteクエリーを生成してください:
     1. 各キーワードはLIKE演算子を使用して部分一致検索する (%keyword%)
-    2. 各キーワードは複数のカラム（short_description, description, resolution,error_code）で検索する
-    3. 検索結果はincident_numberの降順でソート
-    4. 検索結果は最大5件に制限する
+    2. 各キーワードは複数のカラム（i.short_description, i.description, i.resolution, i.error_code）で検索する
+    3. ほぼ同じ内容のインシデントは c.cluster_id でグループ化して1件にまとめ、クラスタ全体のインシデントの件数を duplicate_count として取得する
+    4. 検索結果はクラスタ内の最新のincident_numberの降順でソート
+    5. 検索結果は最大5件に制限する
+    6. SELECT句では以下のコンパクトな列のみを取得し、description と resolution の全文は取得しない:
+       SELECT {", ".join(COMPACT_COLUMNS)},
+              MAX(i.incident_number) AS latest_incident_number,
+              (SELECT COUNT(*) FROM incident_clusters m WHERE m.cluster_id = c.cluster_id) AS duplicate_count
+       FROM incidents i
+       JOIN incident_summaries s ON s.incident_number = i.incident_number
+       JOIN incident_clusters c ON c.incident_number = i.incident_number
+       WHERE ...
+       GROUP BY c.cluster_id
+       ORDER BY latest_incident_number DESC
+       LIMIT 5
 
     生成されたSQLクエリーを '{SQL_QUERY_FILE}' にファイル保存してください。
 
@@ -163,14 +391,11 @@ sql_query_agent = Agent(
 # SQLクエリー実行エージェント
 sql_executor_agent = Agent(
     name="SQL Query Executor",
-    model=OpenAIChat("gpt-4o-mini", api_key=api_key),
+    model=ScheduledOpenAIChat("gpt-4o-mini", api_key=api_key),
     role=f"""
     あなたの役割は、SQLクエリーを使ってSQLiteデータベースに対して実行することです。
     
-    実行手順:
-    1. '{SQL_QUERY_FILE}'から実行するSQLを読み込んだ後、SQLToolsを使用してデータベースにクエリを実行する
-    2. 検索結果の件数を表示する
-    3. 取得した各レコードの完全な情報をfile_toolsを使ってローカルフォルダ内に保存する
+    実行手順:{sql_execution_steps}
     
     ファイル保存のルール:
     - 検索結果は必ず "{SQL_RESULTS_FILE}" に保存してください
@@ -184,21 +409,22 @@ sql_executor_agent = Agent(
        - system_name: システム名
        - module: モジュール名
        - short_description: 概要
-       - description: 詳細説明
-       - resolution: 解決策
-       - error_code: エラーコード
+       - error_code / error_codes: エラーコード
+       - symptoms: 主な症状
+       - resolution_gist: 解決策の要点
        - affected_version: 影響バージョン
+       - duplicate_count: データベース全体でほぼ同じ内容のインシデント（同じクラスタ）の件数
     3. 結果がなかった場合は「検索結果: 0件」と表示
     4. 最後に「検索結果を {SQL_RESULTS_FILE} に保存しました」と表示
      """,
-    tools=[sql_tools,file_tools],
+    tools=sql_executor_tools,
     markdown=True,
 )
 
 # 新規Web検索エージェント
 web_search_agent = Agent(
     name="Web Search Agent",
-    model=OpenAIChat("gpt-4o-mini", api_key=api_key),
+    model=ScheduledOpenAIChat("gpt-4o-mini", api_key=api_key),
     role=f"""
     あなたは外部情報源から関連情報を収集し、包括的な調査報告書を作成するWeb検索エージェントです。
     データベースで情報が見つからなかった場合に、以下のツールを使いWEB検索で情報を収集します：
@@ -301,24 +527,27 @@ web_search_agent = Agent(
 # 新規レポート作成エージェント
 report_generator_agent = Agent(
     name="Report Generator",
-    model=OpenAIChat("gpt-4o-mini", api_key=api_key),
+    model=ScheduledOpenAIChat("gpt-4o-mini", api_key=api_key),
     role=f"""
-    あなたはIT問い合わせに対する調査結果を元に、わかりやすく構造化されたレポートを作成し、必ず reports フォルダ内に保存するエージェントです。
+    あなたはIT問い合わせに対する調査結果を元に、わかりやすく構造化されたレポートを作成し、必ずレポートストアに保存するエージェントです。
     
     ### 注意事項（最重要）:
     - UTF-8エンコードの問題に注意してください。日本語テキストを処理するため、すべてのテキスト操作でUTF-8エンコードを考慮する必要があります。
     - ファイル読み込みでエラーが発生した場合は、ファイルが存在するかを確認し、エラーメッセージを詳細に報告してください。
     
-    ### ファイル読み込み手順:
-    1. 以下のファイルから情報を読み込みます:
-       - "{QUERY_FILE}" - 元の問い合わせ内容
-       - "{SQL_RESULTS_FILE}" - データベース検索結果
-       - "{WEB_RESULTS_FILE}" - Web検索結果（データベース検索が0件の場合のみ）
-    
-    2. ファイル読み込み時のエラー処理:
-       - read_file_with_fallback_encoding()関数を使用してファイルを読み込みます
-       - 読み込みに失敗した場合は、「ファイル読み込みエラー: [ファイル名]」と報告し、処理を続行してください
-       - すべてのエラーを詳細に報告し、可能であれば代替手段を試みてください
+    ### 情報の読み込み手順:
+    1. load_report_context()を実行して、以下の情報をまとめたコンテキストを取得します:
+       - 元の問い合わせ内容
+       - データベース検索結果（問い合わせとの関連度順。症状・エラーコード・解決策の要点のみのコンパクトな形式）
+       - Web検索結果（データベース検索が0件の場合のみ）
+    2. コンテキストはトークン予算内に収まるよう整理されています:
+       - 関連度の低いレコードやWeb検索結果の重要度の低いセクションは短縮・省略されることがあります
+       - 省略した内容は「省略された情報」セクションに一覧で記載されています
+       - 省略された情報は推測で補わず、プレースホルダーを使って完全な形でレポートに展開してください
+    3. レポートで引用するレコードが決まったら、load_incident_details(incident_numbers=...) で引用するレコードの全文（description, resolution）を読み込みます
+       - 全文の読み込みは、問い合わせと関係性が高く実際に引用するレコードだけに限定してください
+       - duplicate_count が2以上のレコードは、ほぼ同じ内容のインシデントをまとめた代表レコードです（duplicate_count はデータベース全体の同様のインシデントの件数）。同様の事例が複数件あることをレポートに記載してください
+    4. 読み込みに失敗した場合は、「ファイル読み込みエラー: [エラー内容]」と報告し、処理を続行してください
     
     ### レポート作成の役割:
     1. 元の問い合わせ内容と検索結果（データベース、WEB検索）を元に、調査報告書を作成する
@@ -329,46 +558,36 @@ report_generator_agent = Agent(
     ### レポート作成のルール:
     1. データベース検索結果がある場合:
        - 元の問い合わせ内容と検索結果（データベース）を突き合わせて、問い合わせ内容と関係性が高い情報だけを利用して調査報告書を作成する
-       - {SQL_RESULTS_FILE}から取得した全てのフィールド（incident_number, status, priority, category等）を全て漏れなく記載する
-       - {SQL_RESULTS_FILE}から取得した description フィールドの内容は、いかなる場合も完全にそのまま（一言一句変えず）レポートに含めること
-       - 各フィールドの値はDBから取得した正確な値をそのまま使用し、変更や要約をしない
-       - 説明（description）フィールドと解決策（resolution）フィールドは特に重要であり、そのままの形で完全に記載する
-       - 絶対に「...」や「省略」などで情報を短縮しない - 全ての情報を完全に表示すること
-       - 「調査結果」セクションの後に「データベースレコードの詳細情報」という別セクションを設け、検索結果の全フィールドを表形式で、省略せずすべて正確に記載する
-       - テキストが長い場合でも、途中で切らずに完全な形で記載すること
+       - 「調査結果」セクションの後に「データベースレコードの詳細情報」という別セクションを設ける
+       - このセクションには、参照した各レコードについて {{{{INCIDENT_DETAILS:インシデント番号}}}} というプレースホルダーを1行で記載する（例: {{{{INCIDENT_DETAILS:INC00008}}}}）
+       - プレースホルダーは保存時に、データベースから読み込んだ全フィールド（description, resolution を含む）を一言一句変えずに記載した表に置き換えられる
+       - 表を自分で書き写したり、「...」や「省略」などで情報を短縮したりしないこと
     
     2. Web検索結果を使用する場合:
-       - ファイル保存の手順（最重要）に従い、{WEB_RESULTS_FILE}の内容をそのまま.mdファイルとして保存する。
+       - レポート本文として {{{{WEB_RESULTS}}}} というプレースホルダーのみを記載する。保存時に{WEB_RESULTS_FILE}の内容がそのまま展開される。
 
     ### データベース検索結果のレポート構成:
     1. 概要: 問い合わせ内容と解決策の要点
     2. 問い合わせ詳細: 原文の問い合わせ内容
-    4. データベースレコード{SQL_RESULTS_FILE}の詳細情報: 
-       - 検索でヒットした全レコードの全フィールドを表形式で正確に表示
-       - フィールド名と値を明確に対応させる
-       - 長文フィールド（description, resolution）も全文を省略せずに記載
-       - すべての取得可能なフィールドを含める
+    4. データベースレコードの詳細情報: 
+       - 参照した全レコードの {{{{INCIDENT_DETAILS:インシデント番号}}}} プレースホルダー
     5. 解決策: 
        - DBに記録された解決策を正確に引用した上で、具体的な推奨対応手順を明記する。
 
 
     ### ファイル保存の手順（最重要）:
-    1. レポートが完成したら、以下の命名規則に従ったファイル名を作成する:
-       - from datetime import datetime # 日付取得用にインポート
-       - 現在の日付を取得: today = datetime.now().strftime("%Y%m%d")
-       - 問い合わせからキーワードを抽出（例: "BenefitAccrual"）
-       - ファイル名を構築: filename = f"reports/report_{today}_キーワード.md"
-       - 必ず"reports/"というプレフィックスを含めること
+    1. 問い合わせから索引に登録するキーワードをカンマ区切りで抽出する（例: "BenefitAccrual, 給与計算"）
     
-    2. レポートファイルの保存:
-       - file_tools.save_file(contents=レポート内容, file_name=filename, overwrite=True)
+    2. レポートの保存:
+       - save_report(contents=レポート内容, keywords=キーワード) を実行する
+       - レポートは日付・キーワード・引用したインシデント番号・情報源で検索できるようにレポートストアに保存される
+       - 同じ内容のレポートが既に保存されている場合は、その旨が返される
        - 保存が成功したかどうかを確認し、結果を報告する
-       - 保存に失敗した場合は理由を詳細に報告し、別の方法を試みる
-       - 内容がUTF-8エンコードであることを確認してからファイルを保存する
+       - 保存に失敗した場合は理由を詳細に報告する
     
 
     """,
-    tools=[file_tools, read_file_with_fallback_encoding],  # Add the new read_file_with_fallback_encoding function as a tool
+    tools=[load_report_context, load_incident_details, save_report, read_file_with_fallback_encoding],
     markdown=True,
 )
 
@@ -377,31 +596,87 @@ report_generator_agent = Agent(
 # チームエージェントの定義（5つのエージェントを組み合わせる）
 support_team = Agent(
     name="IT Support Team",
-    model=OpenAIChat("gpt-4o-mini", api_key=api_key),
+    model=ScheduledOpenAIChat("gpt-4o-mini", api_key=api_key),
     team=[keyword_agent, sql_query_agent, sql_executor_agent, web_search_agent, report_generator_agent],
     instructions=[
         "ユーザーの問い合わせに対して、以下の手順でエージェントを順番に実行してください：",
         "1. Keyword Extractorを実行して重要キーワードを抽出する",
-        "2. SQL Query Generatorでキーワードを基にSQLクエリを生成する",
-        "3. SQL Query Executorを実行してDBを検索する",
-        "4. DBで結果が0件の場合のみ、Web Search Agentを実行する",
-        "5. Report Generatorを実行してレポートを作成する",
+        sql_search_instruction,
+        "3. DBで結果が0件の場合のみ、Web Search Agentを実行する",
+        "4. Report Generatorを実行してレポートを作成する",
     ],
     tools=[file_tools, read_file_with_fallback_encoding],
     show_tool_calls=True,
     markdown=True,
 )
 
+def prepare_ticket_files(question):
+    """問い合わせ内容を保存し、前回の問い合わせの一時ファイルを削除する（処理中のチケットの一時ディレクトリ）"""
+    os.makedirs(_current_temp_dir.get(), exist_ok=True)
+    for file_path in (SQL_QUERY_FILE, SQL_RESULTS_FILE, WEB_RESULTS_FILE):
+        if os.path.exists(ticket_path(file_path)):
+            os.remove(ticket_path(file_path))
+    with open(ticket_path(QUERY_FILE), "w", encoding="utf-8") as f:
+        f.write(question)
+
+
+def process_ticket(question, priority="中", ticket_id=None, profile=None):
+    """
+    問い合わせを1件処理し、回答と保存したレポートを返す。
+
+    Args:
+        question (str): ユーザーの問い合わせ内容
+        priority (str): 問い合わせの優先度（高/中/低）
+        ticket_id (str): チケットID。指定した場合、レポートはチケットIDで検索できるように保存される。
+            一時ファイルは temp_files/<チケットID>/ に作成され、処理後に削除される
+        profile (bool): True の場合はCPUプロファイルとメモリ割り当てを記録して PROFILE_DIR に保存する。
+            None の場合は IT_SUPPORT_PROFILE_SAMPLE_RATE の割合でサンプリングして記録する
+
+    Returns:
+        dict: ticket_id, answer（チームエージェントの回答）, report_id, report（レポート本文）,
+              source（レポートの情報源）, keywords（レポートの索引キーワード）,
+              profile（プロファイルの要約ファイルのパス。記録しなかった場合は None）
+    """
+    temp_dir = ticket_temp_dir(ticket_id or uuid.uuid4().hex)
+    with profile_ticket(ticket_id, enabled=profile, profile_dir=PROFILE_DIR) as ticket_profile:
+        temp_token = _current_temp_dir.set(temp_dir)
+        token = _current_ticket_id.set(ticket_id)
+        try:
+            prepare_ticket_files(question)
+            with call_priority(priority):
+                response = support_team.run(question)
+        finally:
+            _current_ticket_id.reset(token)
+            _current_temp_dir.reset(temp_token)
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    report = None
+    if ticket_id is not None:
+        reports = find_reports(ticket_id=ticket_id, limit=1, db_path=REPORT_DB_FILE)
+        if reports:
+            report = get_report(reports[0]["id"], db_path=REPORT_DB_FILE)
+    return {
+        "ticket_id": ticket_id,
+        "answer": response.content,
+        "report_id": report["id"] if report else None,
+        "report": report["body"] if report else None,
+        "source": reports[0]["source"] if report else None,
+        "keywords": reports[0]["keywords"] if report else None,
+        "profile": ticket_profile.summary_path,
+    }
+
+
 # 使用例    
 if __name__ == "__main__":
     # ユーザー入力を受け取る
     user_question = "給与計算バッチを実行したところ、「BenefitAccrualCalculationFailedException」というエラーメッセージが表示される"
     #user_question = "Azure環境に構築したDjangoアプリケーションで4分前後でタイムアウトが発生してしまう。"
+    # 問い合わせの優先度（高/中/低）。高優先度の問い合わせのモデル呼び出しは待ち行列の先頭に割り込む
+    user_priority = "高"
     
     # ユーザーの問い合わせを保存（ここでクエリファイルを予め保存しておく）
-    os.makedirs(os.path.dirname(QUERY_FILE), exist_ok=True)
-    with open(QUERY_FILE, "w", encoding="utf-8") as f:
-        f.write(user_question)
+    prepare_ticket_files(user_question)
     
     # チームエージェントを実行して結果を表示
-    support_team.print_response(user_question, stream=True)
\ No newline at end of file
+    with call_priority(user_priority):
+        support_team.print_response(user_question, stream=True)
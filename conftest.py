@@ -0,0 +1 @@
+# tests/ からリポジトリ直下のモジュール（agent.py 以外）を import できるようにするためのファイル
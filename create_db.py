@@ -4,6 +4,9 @@ import random
 from datetime import datetime, timedelta
 import json
 
+from incident_clusters import update_clusters
+from incident_summary import refresh_incident_summaries
+
 def setup_database():
     """基幹系システム問い合わせ用データベースのセットアップとサンプルデータの作成"""
     # データベースディレクトリがなければ作成
@@ -15,6 +18,9 @@ def setup_database():
     
     # incidents テーブルの作成（既に存在する場合は削除）
     cursor.execute("DROP TABLE IF EXISTS incidents")
+    cursor.execute("DROP TABLE IF EXISTS incident_summaries")
+    cursor.execute("DROP TABLE IF EXISTS incident_clusters")
+    cursor.execute("DROP TABLE IF EXISTS incident_lsh_buckets")
     cursor.execute('''
     CREATE TABLE incidents (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -39,8 +45,10 @@ def setup_database():
     # サンプルデータを生成して投入
     generate_sample_incidents(cursor, 30)
     
-    # 変更をコミットして接続を閉じる
+    # 変更をコミットし、インシデントのコンパクトな要約とほぼ同じ内容のインシデントのクラスタを作成して接続を閉じる
     conn.commit()
+    refresh_incident_summaries(conn)
+    update_clusters(conn)
     conn.close()
     
     print("基幹系システム問い合わせデータベースのセットアップが完了しました。")
@@ -0,0 +1,236 @@
+import hashlib
+import random
+import re
+from array import array
+
+# MinHash / LSH でほぼ同じ内容のインシデントをクラスタにまとめ、検索結果ではクラスタごとに1件だけ返す
+
+# MinHash の署名の長さ（= バンド数 × バンドあたりの行数）
+NUM_PERM = 64
+LSH_BANDS = 16
+LSH_ROWS = NUM_PERM // LSH_BANDS
+
+# 推定Jaccard類似度がこの値以上のインシデントを同じクラスタとみなす
+JACCARD_THRESHOLD = 0.7
+
+# シングル（文字 n-gram）の長さ
+SHINGLE_SIZE = 3
+
+# クラスタにまとめて件数が減る分を見込んで、検索時に多めに取得する倍率
+OVERFETCH_FACTOR = 4
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+# 全プロセスで同じ署名になるよう、ハッシュ関数の係数は固定のシードで生成する
+_rng = random.Random(20240330)
+_PERMUTATIONS = [(_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME)) for _ in range(NUM_PERM)]
+
+# エラーコードや番号の違いだけのインシデントをまとめるため、英数字の識別子と数字を伏せる
+_IDENTIFIER_PATTERN = re.compile(r"[A-Za-z]*\d[A-Za-z0-9_\-]*")
+
+
+def normalize_text(incident):
+    """クラスタリング用に概要・説明・解決策を連結し、番号やエラーコードを伏せた文字列を返す"""
+    text = "\n".join(str(incident.get(field) or "") for field in ("short_description", "description", "resolution"))
+    text = _IDENTIFIER_PATTERN.sub("#", text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def shingles(text):
+    if len(text) <= SHINGLE_SIZE:
+        return {text} if text else set()
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def minhash_signature(text):
+    """テキストの MinHash 署名（NUM_PERM 個の整数）を返す"""
+    hashes = [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=4).digest(), "little")
+              for s in shingles(text)]
+    if not hashes:
+        return array("Q", [_MAX_HASH] * NUM_PERM)
+    return array("Q", [min(((a * h + b) % _MERSENNE_PRIME) & _MAX_HASH for h in hashes)
+                       for a, b in _PERMUTATIONS])
+
+
+def estimated_jaccard(signature_a, signature_b):
+    """2つの署名から Jaccard 類似度を推定する"""
+    return sum(1 for a, b in zip(signature_a, signature_b) if a == b) / NUM_PERM
+
+
+def lsh_buckets(signature):
+    """署名をバンドに分割し、(バンド番号, バケットのキー) のリストを返す"""
+    return [
+        (band, hashlib.blake2b(signature[band * LSH_ROWS:(band + 1) * LSH_ROWS].tobytes(), digest_size=8).hexdigest())
+        for band in range(LSH_BANDS)
+    ]
+
+
+def _signature_from_blob(blob):
+    signature = array("Q")
+    signature.frombytes(blob)
+    return signature
+
+
+def ensure_cluster_tables(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS incident_clusters (
+        incident_number TEXT PRIMARY KEY,
+        cluster_id TEXT NOT NULL,
+        signature BLOB NOT NULL
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_incident_clusters_cluster ON incident_clusters (cluster_id)")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS incident_lsh_buckets (
+        band INTEGER NOT NULL,
+        bucket TEXT NOT NULL,
+        incident_number TEXT NOT NULL,
+        PRIMARY KEY (band, bucket, incident_number)
+    ) WITHOUT ROWID
+    ''')
+
+
+def assign_clusters(conn, incidents):
+    """
+    インシデントをクラスタに割り当てる（既に割り当て済みのインシデントは割り当て直す）。
+    LSH のバケットが一致する候補のうち、推定Jaccard類似度が JACCARD_THRESHOLD 以上で最も近い
+    インシデントのクラスタに加え、候補がなければそのインシデントを代表とする新しいクラスタを作る。
+    conn には incidents テーブルは不要なため、シャードを横断するクラスタの索引にも使用できる。
+
+    Args:
+        conn (sqlite3.Connection): クラスタを保存するデータベースへの接続
+        incidents (list): incident_number, short_description, description, resolution を持つインシデント（dict）のリスト
+
+    Returns:
+        dict: インシデント番号 → (クラスタID, 署名のバイト列)
+    """
+    cursor = conn.cursor()
+    ensure_cluster_tables(cursor)
+    # 割り当ての結果が登録順に依存しないよう、インシデント番号順に割り当てる
+    incidents = sorted({incident["incident_number"]: incident for incident in incidents}.values(),
+                       key=lambda incident: incident["incident_number"])
+    numbers = [incident["incident_number"] for incident in incidents]
+    for start in range(0, len(numbers), 500):
+        chunk = numbers[start:start + 500]
+        placeholders = ", ".join("?" for _ in chunk)
+        # 内容が変わった可能性があるため、既存の割り当てを外してから割り当て直す
+        cursor.execute(f"DELETE FROM incident_lsh_buckets WHERE incident_number IN ({placeholders})", chunk)
+        cursor.execute(f"DELETE FROM incident_clusters WHERE incident_number IN ({placeholders})", chunk)
+
+    assignments = {}
+    for incident in incidents:
+        signature = minhash_signature(normalize_text(incident))
+        buckets = lsh_buckets(signature)
+
+        candidates = set()
+        for band, bucket in buckets:
+            candidates.update(number for (number,) in cursor.execute(
+                "SELECT incident_number FROM incident_lsh_buckets WHERE band = ? AND bucket = ?", (band, bucket)
+            ))
+        best_cluster, best_similarity = incident["incident_number"], JACCARD_THRESHOLD
+        for number in sorted(candidates):
+            candidate = cursor.execute(
+                "SELECT cluster_id, signature FROM incident_clusters WHERE incident_number = ?", (number,)
+            ).fetchone()
+            if candidate is None:
+                continue
+            similarity = estimated_jaccard(signature, _signature_from_blob(candidate[1]))
+            if similarity >= best_similarity:
+                best_cluster, best_similarity = candidate[0], similarity
+
+        cursor.execute(
+            "INSERT OR REPLACE INTO incident_clusters (incident_number, cluster_id, signature) VALUES (?, ?, ?)",
+            (incident["incident_number"], best_cluster, signature.tobytes()),
+        )
+        cursor.executemany(
+            "INSERT OR IGNORE INTO incident_lsh_buckets (band, bucket, incident_number) VALUES (?, ?, ?)",
+            [(band, bucket, incident["incident_number"]) for band, bucket in buckets],
+        )
+        assignments[incident["incident_number"]] = (best_cluster, signature.tobytes())
+    conn.commit()
+    return assignments
+
+
+def update_clusters(conn, incident_numbers=None):
+    """
+    incidents テーブルのうち、クラスタに未登録のインシデント（または指定したインシデント）をクラスタに割り当て、
+    削除されたインシデントの割り当てを削除する。
+
+    Args:
+        conn (sqlite3.Connection): incidents テーブルを持つデータベースへの接続
+        incident_numbers (list): 割り当て直すインシデント番号（省略時は未登録のインシデントのみ）
+
+    Returns:
+        int: 割り当てたインシデントの件数
+    """
+    cursor = conn.cursor()
+    ensure_cluster_tables(cursor)
+    columns = ["incident_number", "short_description", "description", "resolution"]
+    if incident_numbers is None:
+        rows = cursor.execute('''
+        SELECT i.incident_number, i.short_description, i.description, i.resolution
+        FROM incidents i
+        LEFT JOIN incident_clusters c ON c.incident_number = i.incident_number
+        WHERE c.incident_number IS NULL
+        ''').fetchall()
+    else:
+        incident_numbers = sorted(set(incident_numbers))
+        if not incident_numbers:
+            return 0
+        placeholders = ", ".join("?" for _ in incident_numbers)
+        rows = cursor.execute(
+            f"SELECT {', '.join(columns)} FROM incidents WHERE incident_number IN ({placeholders})",
+            incident_numbers,
+        ).fetchall()
+    assignments = assign_clusters(conn, [dict(zip(columns, row)) for row in rows])
+
+    # 削除されたインシデントの割り当てを削除する
+    cursor.execute("DELETE FROM incident_lsh_buckets WHERE incident_number NOT IN (SELECT incident_number FROM incidents)")
+    cursor.execute("DELETE FROM incident_clusters WHERE incident_number NOT IN (SELECT incident_number FROM incidents)")
+    conn.commit()
+    return len(assignments)
+
+
+def store_cluster_ids(conn, assignments):
+    """assign_clusters() の結果（別のデータベースで割り当てたクラスタ）を conn の incident_clusters テーブルに保存する"""
+    cursor = conn.cursor()
+    ensure_cluster_tables(cursor)
+    cursor.executemany(
+        "INSERT OR REPLACE INTO incident_clusters (incident_number, cluster_id, signature) VALUES (?, ?, ?)",
+        [(number, cluster_id, signature) for number, (cluster_id, signature) in assignments.items()],
+    )
+    conn.commit()
+
+
+def cluster_sizes(conn, cluster_ids):
+    """クラスタIDごとのインシデントの件数を返す"""
+    cluster_ids = sorted(set(cluster_ids))
+    if not cluster_ids:
+        return {}
+    placeholders = ", ".join("?" for _ in cluster_ids)
+    return dict(conn.execute(
+        f"SELECT cluster_id, COUNT(*) FROM incident_clusters WHERE cluster_id IN ({placeholders}) GROUP BY cluster_id",
+        cluster_ids,
+    ))
+
+
+def collapse_rows(rows, limit=None):
+    """
+    順位の高い順に並んだ検索結果から、同じクラスタ（cluster_id が同じ）のレコードをまとめ、
+    各クラスタの最上位のレコードだけを残す。
+
+    Args:
+        rows (list): cluster_id を持つレコード（dict）のリスト（cluster_id がない場合は1件で1クラスタ）
+        limit (int): 返す最大件数
+
+    Returns:
+        list: 代表レコード（dict）のリスト
+    """
+    representatives, seen = [], set()
+    for row in rows:
+        cluster_id = row.get("cluster_id") or row.get("incident_number")
+        if cluster_id in seen:
+            continue
+        seen.add(cluster_id)
+        representatives.append(row)
+    return representatives[:limit] if limit is not None else representatives
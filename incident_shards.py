@@ -0,0 +1,350 @@
+import heapq
+import json
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from incident_clusters import OVERFETCH_FACTOR, assign_clusters, cluster_sizes, collapse_rows, store_cluster_ids
+from incident_summary import COMPACT_COLUMNS, refresh_incident_summaries
+
+# インシデントをシステム名・作成月ごとのSQLiteファイル（シャード）に分割して保存・検索する
+
+SOURCE_DB = ".db/it_support.db"
+SHARD_DIR = ".db/shards"
+MANIFEST_FILE = "manifest.json"
+# シャードを横断してほぼ同じ内容のインシデントをクラスタにまとめるための索引（incident_clusters.py）
+CLUSTER_INDEX_FILE = "clusters.db"
+
+# シャードの分割キー（system_name: システム名ごと、month: created_at の年月ごと）
+SHARD_KEYS = ("system_name", "month")
+DEFAULT_SHARD_BY = ("system_name", "month")
+
+# 検索時に各カラムでキーワードが一致した場合のスコア
+SEARCH_COLUMN_WEIGHTS = {
+    "error_code": 3,
+    "short_description": 2,
+    "description": 1,
+    "resolution": 1,
+}
+
+# シャードを並列に検索するスレッド数（sqlite3 はクエリの実行中に GIL を解放する）
+SEARCH_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# キーワードからシステムを特定するための別名（システム名そのものは常に一致する）
+# 「Sales」「ERP」「Cloud」のような一般的な語で他のシステムのシャードを除外しないよう、部分一致では判定しない
+SYSTEM_ALIASES = {
+    "SAP ERP": ["SAP"],
+    "Oracle EBS": ["Oracle E-Business Suite", "EBS"],
+    "Microsoft Dynamics 365": ["Dynamics 365", "Dynamics", "D365"],
+    "Infor CloudSuite": ["Infor", "CloudSuite"],
+    "Salesforce": ["SFDC"],
+}
+
+INCIDENT_COLUMNS = [
+    "incident_number", "created_at", "status", "priority", "category", "subcategory",
+    "system_name", "module", "short_description", "description", "resolution",
+    "assigned_to", "updated_at", "error_code", "affected_version",
+]
+
+
+def _slug(value):
+    return re.sub(r"[^0-9a-z]+", "_", str(value).lower()).strip("_") or "unknown"
+
+
+def shard_key(incident, shard_by=DEFAULT_SHARD_BY):
+    """インシデントの分割キーから (シャード名, メタデータ) を返す"""
+    parts, meta = [], {}
+    if "system_name" in shard_by:
+        meta["system_name"] = incident.get("system_name") or ""
+        parts.append(_slug(meta["system_name"]))
+    if "month" in shard_by:
+        created_at = str(incident.get("created_at") or "")
+        meta["month"] = created_at[:7].replace("-", "") if len(created_at) >= 7 else "unknown"
+        parts.append(meta["month"])
+    return "_".join(parts) or "all", meta
+
+
+def _create_incidents_table(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS incidents (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        incident_number TEXT UNIQUE,
+        created_at TIMESTAMP,
+        status TEXT,
+        priority TEXT,
+        category TEXT,
+        subcategory TEXT,
+        system_name TEXT,
+        module TEXT,
+        short_description TEXT,
+        description TEXT,
+        resolution TEXT,
+        assigned_to TEXT,
+        updated_at TIMESTAMP,
+        error_code TEXT,
+        affected_version TEXT
+    )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_incidents_error_code ON incidents (error_code)")
+
+
+def load_manifest(shard_dir=SHARD_DIR):
+    """シャード一覧（manifest.json）を読み込む。存在しない場合は None を返す"""
+    path = os.path.join(shard_dir, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest, shard_dir):
+    path = os.path.join(shard_dir, MANIFEST_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+def insert_incidents(incidents, shard_dir=SHARD_DIR, shard_by=None):
+    """
+    インシデントを分割キーに対応するシャードに書き込む（同じ incident_number は上書き）。
+    分割キーが変わった場合は、以前のシャードのレコードを削除してから新しいシャードに書き込む。
+
+    Args:
+        incidents (list): インシデント（dict）のリスト
+        shard_dir (str): シャードを保存するディレクトリ
+        shard_by (tuple): 分割キー。省略時は既存のmanifestの設定、なければ DEFAULT_SHARD_BY
+
+    Returns:
+        dict: 更新後のmanifest
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    manifest = load_manifest(shard_dir) or {"shard_by": list(shard_by or DEFAULT_SHARD_BY), "shards": {}}
+    if shard_by is not None and tuple(shard_by) != tuple(manifest["shard_by"]):
+        raise ValueError(f"既存のシャードの分割キー {manifest['shard_by']} と一致しません: {list(shard_by)}")
+    unknown = set(manifest["shard_by"]) - set(SHARD_KEYS)
+    if unknown:
+        raise ValueError(f"未対応の分割キーです: {sorted(unknown)}")
+
+    # シャードごとにまとめて書き込む
+    grouped = {}
+    for incident in incidents:
+        name, meta = shard_key(incident, manifest["shard_by"])
+        grouped.setdefault(name, (meta, []))[1].append(incident)
+
+    # 分割キー（システム名・作成月）が変わったインシデントは、以前のシャードから削除する
+    _remove_from_other_shards(manifest, shard_dir, grouped)
+
+    # クラスタはシャードを横断して割り当て、各シャードには割り当てたクラスタIDを保存する
+    index = sqlite3.connect(os.path.join(shard_dir, CLUSTER_INDEX_FILE))
+    try:
+        assignments = assign_clusters(index, incidents)
+    finally:
+        index.close()
+
+    placeholders = ", ".join("?" for _ in INCIDENT_COLUMNS)
+    for name, (meta, rows) in grouped.items():
+        file_name = f"{name}.db"
+        conn = sqlite3.connect(os.path.join(shard_dir, file_name))
+        try:
+            _create_incidents_table(conn)
+            conn.executemany(
+                f"INSERT OR REPLACE INTO incidents ({', '.join(INCIDENT_COLUMNS)}) VALUES ({placeholders})",
+                [tuple(row.get(column) for column in INCIDENT_COLUMNS) for row in rows],
+            )
+            conn.commit()
+            incident_numbers = [row.get("incident_number") for row in rows]
+            refresh_incident_summaries(conn, incident_numbers, force=True)
+            store_cluster_ids(conn, {number: assignments[number] for number in incident_numbers})
+            count = conn.execute("SELECT COUNT(*) FROM incidents").fetchone()[0]
+        finally:
+            conn.close()
+        manifest["shards"][name] = dict(meta, file=file_name, count=count)
+
+    _save_manifest(manifest, shard_dir)
+    return manifest
+
+
+def _remove_from_other_shards(manifest, shard_dir, grouped):
+    """書き込み先以外のシャードに残っている同じ incident_number のレコード（要約・クラスタIDを含む）を削除する"""
+    for name, shard in manifest["shards"].items():
+        stale = [row.get("incident_number") for other, (_, rows) in grouped.items() if other != name for row in rows]
+        if not stale:
+            continue
+        placeholders = ", ".join("?" for _ in stale)
+        conn = sqlite3.connect(os.path.join(shard_dir, shard["file"]))
+        try:
+            deleted = conn.execute(f"DELETE FROM incidents WHERE incident_number IN ({placeholders})", stale).rowcount
+            if not deleted:
+                continue
+            for table in ("incident_summaries", "incident_clusters"):
+                conn.execute(f"DELETE FROM {table} WHERE incident_number IN ({placeholders})", stale)
+            conn.commit()
+            shard["count"] = conn.execute("SELECT COUNT(*) FROM incidents").fetchone()[0]
+        finally:
+            conn.close()
+
+
+def build_shards(source_db=SOURCE_DB, shard_dir=SHARD_DIR, shard_by=DEFAULT_SHARD_BY):
+    """単一のデータベースファイルのインシデントをシャードに分割する（既存のシャードは作り直す）"""
+    if os.path.isdir(shard_dir):
+        for file_name in os.listdir(shard_dir):
+            if file_name.endswith(".db") or file_name == MANIFEST_FILE:
+                os.remove(os.path.join(shard_dir, file_name))
+
+    conn = sqlite3.connect(source_db)
+    conn.row_factory = sqlite3.Row
+    try:
+        incidents = [dict(row) for row in conn.execute(f"SELECT {', '.join(INCIDENT_COLUMNS)} FROM incidents")]
+    finally:
+        conn.close()
+    return insert_incidents(incidents, shard_dir, shard_by)
+
+
+def _normalize_name(value):
+    return re.sub(r"\s+", " ", value.strip().lower())
+
+
+def systems_in_keywords(keywords, system_names):
+    """
+    キーワードに含まれるシステム名を返す（大文字小文字は区別しない）。
+    システム名または SYSTEM_ALIASES の別名が、語の区切りで一致する場合のみ対象とする。
+    """
+    matched = set()
+    for keyword in keywords:
+        keyword = _normalize_name(keyword)
+        for system_name in system_names:
+            for name in [system_name] + SYSTEM_ALIASES.get(system_name, []):
+                if re.search(rf"(?<![0-9a-z]){re.escape(_normalize_name(name))}(?![0-9a-z])", keyword):
+                    matched.add(system_name)
+                    break
+    return matched
+
+
+def select_shards(manifest, keywords):
+    """検索対象のシャードを選ぶ。キーワードでシステム名が指定されていればそのシステムのシャードのみ"""
+    shards = list(manifest["shards"].values())
+    if "system_name" not in manifest["shard_by"]:
+        return shards
+    systems = systems_in_keywords(keywords, {shard["system_name"] for shard in shards})
+    if not systems:
+        return shards
+    return [shard for shard in shards if shard["system_name"] in systems]
+
+
+def search_shard(db_path, keywords, limit):
+    """
+    1つのシャードをキーワードで検索し、スコア（rank）の高い順に最大 limit 件返す。
+    照合は全文に対して行い、結果はコンパクトな要約の列（COMPACT_COLUMNS）と、
+    ほぼ同じ内容のインシデントをまとめるためのクラスタID（cluster_id）で返す。
+    """
+    score_terms, params = [], []
+    for keyword in keywords:
+        for column, weight in SEARCH_COLUMN_WEIGHTS.items():
+            score_terms.append(f"(CASE WHEN i.{column} LIKE ? THEN {weight} ELSE 0 END)")
+            params.append(f"%{keyword}%")
+    query = f'''
+    SELECT * FROM (
+        SELECT {', '.join(COMPACT_COLUMNS)}, c.cluster_id, ({' + '.join(score_terms)}) AS rank
+        FROM incidents i
+        JOIN incident_summaries s ON s.incident_number = i.incident_number
+        LEFT JOIN incident_clusters c ON c.incident_number = i.incident_number
+    )
+    WHERE rank > 0
+    ORDER BY rank DESC, incident_number DESC
+    LIMIT ?
+    '''
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        return [dict(row) for row in conn.execute(query, params + [limit])]
+    finally:
+        conn.close()
+
+
+_search_executor = None
+_search_executor_lock = threading.Lock()
+
+
+def _get_search_executor():
+    """シャードの検索に使うスレッドプールを返す（初回の呼び出し時に作成し、以降の検索で使い回す）"""
+    global _search_executor
+    with _search_executor_lock:
+        if _search_executor is None:
+            _search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="incident-search")
+        return _search_executor
+
+
+def search_incidents(keywords, limit=5, shard_dir=SHARD_DIR):
+    """
+    シャードを横断してキーワード検索し、rank の高い順に上位 limit 件をマージして返す。
+    キーワードにシステム名が含まれる場合は、そのシステムのシャードのみを検索する。
+    ほぼ同じ内容のインシデント（シャードを横断したクラスタ）は1件の代表レコードにまとめ、
+    duplicate_count にクラスタ全体のインシデントの件数を設定する。
+    複数のシャードは、モジュールで共有するスレッドプール（SEARCH_WORKERS）で並列に検索する。
+
+    Args:
+        keywords (list): 検索キーワードのリスト
+        limit (int): 取得する最大件数
+        shard_dir (str): シャードを保存したディレクトリ
+
+    Returns:
+        list: インシデント（dict、rank と duplicate_count フィールド付き）のリスト
+    """
+    keywords = [keyword.strip() for keyword in keywords if keyword and keyword.strip()]
+    manifest = load_manifest(shard_dir)
+    if not keywords or not manifest:
+        return []
+
+    # クラスタにまとめて件数が減る分を見込んで多めに取得する
+    shard_limit = limit * OVERFETCH_FACTOR
+    paths = [os.path.join(shard_dir, shard["file"]) for shard in select_shards(manifest, keywords)]
+    if len(paths) <= 1:
+        results = [search_shard(path, keywords, shard_limit) for path in paths]
+    else:
+        executor = _get_search_executor()
+        results = list(executor.map(search_shard, paths, [keywords] * len(paths), [shard_limit] * len(paths)))
+
+    rows = (row for shard_rows in results for row in shard_rows)
+    ranked = heapq.nlargest(shard_limit, rows, key=lambda row: (row["rank"], row["incident_number"]))
+    representatives = collapse_rows(ranked, limit)
+
+    sizes = {}
+    index_path = os.path.join(shard_dir, CLUSTER_INDEX_FILE)
+    if os.path.exists(index_path):
+        index = sqlite3.connect(f"file:{index_path}?mode=ro", uri=True)
+        try:
+            sizes = cluster_sizes(index, [row["cluster_id"] for row in representatives if row.get("cluster_id")])
+        finally:
+            index.close()
+    for row in representatives:
+        row["duplicate_count"] = sizes.get(row.get("cluster_id"), 1)
+    return representatives
+
+
+def fetch_incidents(incident_numbers, shard_dir=SHARD_DIR):
+    """インシデント番号を指定して、全シャードから全フィールドのレコードを取得する"""
+    incident_numbers = list(incident_numbers)
+    manifest = load_manifest(shard_dir)
+    if not incident_numbers or not manifest:
+        return []
+    placeholders = ", ".join("?" for _ in incident_numbers)
+    rows = []
+    for shard in manifest["shards"].values():
+        conn = sqlite3.connect(f"file:{os.path.join(shard_dir, shard['file'])}?mode=ro", uri=True)
+        conn.row_factory = sqlite3.Row
+        try:
+            rows.extend(dict(row) for row in conn.execute(
+                f"SELECT {', '.join(INCIDENT_COLUMNS)} FROM incidents WHERE incident_number IN ({placeholders})",
+                incident_numbers,
+            ))
+        finally:
+            conn.close()
+    return rows
+
+
+if __name__ == "__main__":
+    manifest = build_shards()
+    print(f"{len(manifest['shards'])}個のシャードを {SHARD_DIR} に作成しました。")
@@ -0,0 +1,183 @@
+import re
+
+# インシデントごとのコンパクトな要約（主な症状・エラーコード・影響モジュール・解決策の要点）を作成して保存する
+# 検索結果の照合やレポート作成のプロンプトには要約を使い、全文は最終的に引用するレコードだけ読み込む
+
+# 要約の作成方法を変更した場合は値を上げる（保存済みの要約がすべて再作成される）
+SUMMARY_VERSION = 2
+
+# 症状・解決策の要点の最大文字数
+MAX_SYMPTOMS_CHARS = 200
+MAX_GIST_CHARS = 200
+
+# 検索結果として返すコンパクトな列（incidents: i、incident_summaries: s）
+COMPACT_COLUMNS = [
+    "i.incident_number", "i.status", "i.priority", "i.category", "i.system_name", "i.module",
+    "i.short_description", "i.error_code", "s.error_codes", "s.symptoms", "s.resolution_gist",
+    "i.affected_version",
+]
+
+# 症状を表す文に含まれる語
+SYMPTOM_WORDS = ("エラー", "ダンプ", "例外", "表示", "発生", "失敗", "中断", "停止", "されません", "できません", "遅", "タイムアウト")
+
+_NOT_CODE_BEFORE = r"(?<![A-Za-z0-9_\-])"
+_NOT_CODE_AFTER = r"(?![A-Za-z0-9_\-])"
+
+# 名前からエラーだとわかる形式（説明文のどこにあってもエラーコードとみなす）
+_NAMED_ERROR_PATTERN = re.compile(
+    rf"{_NOT_CODE_BEFORE}("
+    r"[A-Z][A-Za-z]+(?:Exception|Error)"                         # BenefitAccrualCalculationFailedException
+    r"|[A-Z][A-Z0-9]*(?:_[A-Z0-9]+)*_(?:ERROR|EXCEPTION|FAILED)"  # DBIF_RSQL_SQL_ERROR
+    rf"){_NOT_CODE_AFTER}"
+)
+
+# 英大文字と数字のコード。材料番号・バッチ番号・受注番号・プログラム名と同じ形のため、
+# 説明文ではエラーを表す語と隣接している場合のみエラーコードとみなす
+_CODE = (
+    r"[A-Z]{2,}(?:_[A-Z0-9]+)+"        # MESSAGE_TYPE_X
+    r"|[A-Z]{2,}(?:-[A-Z]+)*-\d{3,}"   # ORA-01555, ION-VAL-1022
+    r"|[A-Z]{1,4}\d{3,}"               # F5003, V7100
+)
+_CODE_PATTERN = re.compile(rf"{_NOT_CODE_BEFORE}(?:{_CODE}){_NOT_CODE_AFTER}")
+_ERROR_WORDS = r"(?:エラー|ダンプ|例外)"
+_CODE_IN_CONTEXT_PATTERN = re.compile(
+    rf"(?:エラーコード|エラー番号|メッセージ番号)[\s:：「]*{_NOT_CODE_BEFORE}({_CODE}){_NOT_CODE_AFTER}"  # エラーコード F5003
+    rf"|{_NOT_CODE_BEFORE}({_CODE}){_NOT_CODE_AFTER}\s*(?:という)?{_ERROR_WORDS}"                      # V7100というエラー
+    rf"|「({_CODE})(?:[:：][^」\n]*)?」(?:という)?{_ERROR_WORDS}"                                       # 「ORA-01555: ...」エラー
+)
+_NUMBERED_LINE_PATTERN = re.compile(r"^\s*(?:\d+[.．)]|[-・])\s*")
+
+
+def _sentences(text):
+    """文（「。」または改行区切り）のリストを返す"""
+    return [s.strip() for s in re.split(r"(?<=。)|\n", text or "") if s.strip()]
+
+
+def _truncate(text, limit):
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+
+def _join_within(parts, limit, separator=" "):
+    joined = ""
+    for part in parts:
+        candidate = f"{joined}{separator}{part}" if joined else part
+        if len(candidate) > limit:
+            break
+        joined = candidate
+    if not joined and parts:
+        return _truncate(parts[0], limit)
+    return joined
+
+
+def extract_error_codes(incident):
+    """
+    error_code フィールドと説明文からエラーコードを抽出する（重複は除く）。
+    説明文からは、名前からエラーだとわかるもの（〜Exception、〜_ERROR など）と、
+    エラーを表す語と隣接するコード（「エラーコード F5003」「V7100というエラー」など）のみ抽出する。
+    """
+    error_code = incident.get("error_code")
+    codes = [error_code] if error_code else []
+    found = _CODE_PATTERN.findall(error_code or "") + _NAMED_ERROR_PATTERN.findall(error_code or "")
+    for text in (incident.get("short_description"), incident.get("description")):
+        found += _NAMED_ERROR_PATTERN.findall(text or "")
+        found += [next(code for code in groups if code) for groups in _CODE_IN_CONTEXT_PATTERN.findall(text or "")]
+    for code in found:
+        if code not in codes:
+            codes.append(code)
+    return codes
+
+
+def extract_symptoms(description):
+    """説明文の冒頭の文と、症状を表す文を抽出する（手順の行は症状を含む場合のみ）"""
+    sentences = _sentences(description)
+    if not sentences:
+        return ""
+    picked = [sentences[0]]
+    for sentence in sentences[1:]:
+        if any(word in sentence for word in SYMPTOM_WORDS):
+            picked.append(_NUMBERED_LINE_PATTERN.sub("", sentence))
+    return _join_within(picked, MAX_SYMPTOMS_CHARS)
+
+
+def extract_resolution_gist(resolution):
+    """解決策から原因を述べた文と、最初の対応手順を抽出する"""
+    sentences = _sentences(resolution)
+    if not sentences:
+        return ""
+    cause = next((s for s in sentences if "原因" in s), sentences[0])
+    steps = [_NUMBERED_LINE_PATTERN.sub("", s) for s in sentences if _NUMBERED_LINE_PATTERN.match(s)]
+    parts = [cause] + [f"対応: {step}" for step in steps[:2]]
+    return _join_within(parts, MAX_GIST_CHARS)
+
+
+def build_summary(incident):
+    """インシデント（dict）からコンパクトな要約（dict）を作成する"""
+    return {
+        "incident_number": incident["incident_number"],
+        "error_codes": ", ".join(extract_error_codes(incident)),
+        "symptoms": extract_symptoms(incident.get("description")),
+        "resolution_gist": extract_resolution_gist(incident.get("resolution")),
+    }
+
+
+def ensure_summary_table(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS incident_summaries (
+        incident_number TEXT PRIMARY KEY,
+        error_codes TEXT,
+        symptoms TEXT,
+        resolution_gist TEXT,
+        summary_version INTEGER,
+        source_updated_at TIMESTAMP
+    )
+    ''')
+
+
+def refresh_incident_summaries(conn, incident_numbers=None, force=False):
+    """
+    要約がない、またはインシデントの updated_at や要約の作成方法が変わったインシデントの要約を作成し直す。
+    削除されたインシデントの要約は削除する。
+
+    Args:
+        conn (sqlite3.Connection): incidents テーブルを持つデータベースへの接続
+        incident_numbers (list): 対象を限定するインシデント番号（省略時は全件を確認する）
+        force (bool): True の場合は updated_at に関わらず対象の要約を作成し直す
+
+    Returns:
+        int: 作成し直した要約の件数
+    """
+    cursor = conn.cursor()
+    ensure_summary_table(cursor)
+    query = '''
+    SELECT i.incident_number, i.short_description, i.description, i.resolution, i.error_code, i.updated_at
+    FROM incidents i
+    LEFT JOIN incident_summaries s ON s.incident_number = i.incident_number
+    WHERE (? OR s.incident_number IS NULL
+           OR s.summary_version IS NOT ?
+           OR s.source_updated_at IS NOT i.updated_at)
+    '''
+    params = [int(force), SUMMARY_VERSION]
+    if incident_numbers is not None:
+        incident_numbers = list(incident_numbers)
+        if not incident_numbers:
+            return 0
+        query += f" AND i.incident_number IN ({', '.join('?' for _ in incident_numbers)})"
+        params.extend(incident_numbers)
+
+    columns = ["incident_number", "short_description", "description", "resolution", "error_code", "updated_at"]
+    rows = [dict(zip(columns, row)) for row in cursor.execute(query, params).fetchall()]
+    cursor.executemany('''
+    INSERT OR REPLACE INTO incident_summaries (
+        incident_number, error_codes, symptoms, resolution_gist, summary_version, source_updated_at
+    ) VALUES (?, ?, ?, ?, ?, ?)
+    ''', [
+        (summary["incident_number"], summary["error_codes"], summary["symptoms"], summary["resolution_gist"],
+         SUMMARY_VERSION, row["updated_at"])
+        for row, summary in ((row, build_summary(row)) for row in rows)
+    ])
+    cursor.execute('''
+    DELETE FROM incident_summaries
+    WHERE incident_number NOT IN (SELECT incident_number FROM incidents)
+    ''')
+    conn.commit()
+    return len(rows)
@@ -0,0 +1,349 @@
+import asyncio
+import contextvars
+import heapq
+import itertools
+import random
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Optional
+
+from agno.models.openai import OpenAIChat
+
+from report_context import count_tokens
+
+# 全エージェントのモデル呼び出しを、プロセス全体で共有するレート制限と優先度付きキューを通して実行する
+
+# 優先度クラス（値が小さいほど先に実行される）
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# インシデントの優先度（高/中/低）と優先度クラスの対応
+PRIORITY_CLASSES = {
+    "高": PRIORITY_HIGH,
+    "中": PRIORITY_NORMAL,
+    "低": PRIORITY_LOW,
+}
+
+# 再試行の対象とするHTTPステータスコード
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+# 応答トークン数の見積もり（max_tokens が指定されていない場合）
+DEFAULT_COMPLETION_TOKENS = 1024
+
+_current_priority = contextvars.ContextVar("model_call_priority", default=PRIORITY_NORMAL)
+
+
+@contextmanager
+def call_priority(priority):
+    """
+    このコンテキスト内のモデル呼び出しの優先度クラスを設定する。
+
+    Args:
+        priority (int or str): 優先度クラス（PRIORITY_HIGH など）、またはインシデントの優先度（"高"/"中"/"低"）
+    """
+    if isinstance(priority, str):
+        priority = PRIORITY_CLASSES.get(priority, PRIORITY_NORMAL)
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+class TokenBucket:
+    """1分あたりの上限を一定速度で補充するトークンバケット"""
+
+    def __init__(self, per_minute, clock=time.monotonic):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """amount 分を消費できるようになるまでの秒数（すぐに消費できる場合は 0）"""
+        self._refill()
+        # バケットの容量を超える要求は、満杯になった時点で許可する
+        amount = min(amount, self.capacity)
+        # 浮動小数点の誤差で極小の待機時間が続かないよう、わずかな不足は許容する
+        if self.tokens >= amount - 1e-9:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= amount
+
+    def drain(self, seconds=0.0):
+        """バケットを空にし、さらに seconds 秒間は補充されないようにする（その後は補充速度で徐々に再開する）"""
+        self._refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class ModelCallScheduler:
+    """
+    モデル呼び出しのスケジューラー。
+    - リクエスト数とトークン数の1分あたりの上限をトークンバケットで管理する
+    - 待機中の呼び出しは優先度クラス順（同じ優先度なら到着順）に実行する
+    - 429などの一時的なエラーはジッター付き指数バックオフで再試行し、Retry-After ヘッダーがあればそれに従う
+    - 429を受けた場合は全呼び出しを一時停止してバケットを空にし、停止の解除後も一斉に再試行が集中するのを防ぐ
+    """
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=200000, max_retries=5,
+                 base_delay=1.0, max_delay=60.0, clock=time.monotonic, sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self.requests = TokenBucket(requests_per_minute, clock)
+        self.tokens = TokenBucket(tokens_per_minute, clock)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._condition = threading.Condition()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+
+    def acquire(self, estimated_tokens, priority=None):
+        """レート制限の枠が空き、かつ自分より優先度の高い呼び出しがなくなるまで待機してから枠を消費する"""
+        if priority is None:
+            priority = _current_priority.get()
+        entry = (priority, next(self._sequence))
+        with self._condition:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    if self._waiting[0] == entry:
+                        wait = max(
+                            self._paused_until - self.clock(),
+                            self.requests.wait_time(1),
+                            self.tokens.wait_time(estimated_tokens),
+                        )
+                        if wait <= 0:
+                            self.requests.consume(1)
+                            self.tokens.consume(estimated_tokens)
+                            return
+                        self._wait(wait)
+                    else:
+                        self._condition.wait()
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._condition.notify_all()
+
+    def _wait(self, timeout):
+        """条件変数のロックを保持した状態で、timeout 秒または通知があるまで待機する"""
+        if self.sleep is time.sleep:
+            self._condition.wait(timeout=timeout)
+            return
+        # sleep が差し替えられている場合（テストの仮想時計など）は、その sleep で待機する
+        self._condition.release()
+        try:
+            self.sleep(timeout)
+        finally:
+            self._condition.acquire()
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """実際の使用トークン数との差分をトークンバケットに反映する"""
+        if actual_tokens is None:
+            return
+        with self._condition:
+            self.tokens.consume(actual_tokens - estimated_tokens)
+            self._condition.notify_all()
+
+    def _pause(self, seconds):
+        with self._condition:
+            now = self.clock()
+            self._paused_until = max(self._paused_until, now + seconds)
+            # 停止の解除時に待機中の呼び出しが一斉に送信されないよう、両方のバケットを空にして
+            # 停止の解除後は補充速度に従って徐々に再開させる
+            self.requests.drain(self._paused_until - now)
+            self.tokens.drain(self._paused_until - now)
+            self._condition.notify_all()
+
+    def _retry_delay(self, error, attempt):
+        """再試行までの待機秒数。再試行しないエラーの場合は None"""
+        retryable, status_code = _classify_error(error)
+        if not retryable or attempt >= self.max_retries:
+            return None
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = min(retry_after, self.max_delay) + random.uniform(0, self.base_delay)
+        else:
+            # Full Jitter: 0 〜 min(上限, 基準 * 2^試行回数) の一様乱数
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        if status_code == 429:
+            self._pause(delay)
+        return delay
+
+    def call(self, func, estimated_tokens, priority=None):
+        """
+        レート制限と優先度に従って func を実行し、一時的なエラーの場合は再試行する。
+
+        Args:
+            func (callable): モデル呼び出しを行う引数なしの関数
+            estimated_tokens (int): 見積もりトークン数（入力 + 応答）
+            priority (int): 優先度クラス。省略時は call_priority() で設定された値
+
+        Returns:
+            func の戻り値
+        """
+        if priority is None:
+            priority = _current_priority.get()
+        for attempt in itertools.count():
+            self.acquire(estimated_tokens, priority)
+            try:
+                return func()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+            self.sleep(delay)
+
+    async def acall(self, func, estimated_tokens, priority=None):
+        """call() の非同期版。func はコルーチンを返す引数なしの関数"""
+        if priority is None:
+            priority = _current_priority.get()
+        for attempt in itertools.count():
+            await asyncio.to_thread(self.acquire, estimated_tokens, priority)
+            try:
+                return await func()
+            except Exception as e:
+                delay = self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+
+
+def _error_chain(error):
+    while error is not None:
+        yield error
+        error = error.__cause__
+
+
+def _classify_error(error):
+    """エラーを (再試行するか, HTTPステータスコード) に分類する"""
+    chain = list(_error_chain(error))
+    for e in chain:
+        status_code = getattr(getattr(e, "response", None), "status_code", None)
+        if isinstance(status_code, int):
+            return status_code in RETRYABLE_STATUS_CODES, status_code
+    # agno は元の例外を cause に持つ ModelProviderError に包むため、元の例外で判定する
+    root = chain[-1]
+    if isinstance(root, (ConnectionError, TimeoutError)) or type(root).__name__ in ("APIConnectionError", "APITimeoutError"):
+        return True, None
+    status_code = getattr(root, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code in RETRYABLE_STATUS_CODES, status_code
+    return False, None
+
+
+def _retry_after(error):
+    """エラーのレスポンスヘッダー（retry-after-ms / retry-after）から待機秒数を取得する"""
+    for e in _error_chain(error):
+        headers = getattr(getattr(e, "response", None), "headers", None)
+        if not headers:
+            continue
+        try:
+            if headers.get("retry-after-ms"):
+                return float(headers["retry-after-ms"]) / 1000
+            if headers.get("retry-after"):
+                return float(headers["retry-after"])
+        except ValueError:
+            # HTTP日付形式の Retry-After は扱わずバックオフに任せる
+            return None
+    return None
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """プロセス全体で共有するスケジューラーを返す"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = ModelCallScheduler()
+        return _scheduler
+
+
+def configure_scheduler(**kwargs):
+    """共有スケジューラーを指定した設定で作り直す（引数は ModelCallScheduler と同じ）"""
+    global _scheduler
+    with _scheduler_lock:
+        _scheduler = ModelCallScheduler(**kwargs)
+        return _scheduler
+
+
+@dataclass
+class ScheduledOpenAIChat(OpenAIChat):
+    """共有スケジューラーを通してAPIを呼び出す OpenAIChat"""
+
+    scheduler: Optional[ModelCallScheduler] = None
+
+    def __post_init__(self):
+        super().__post_init__()
+        # 再試行はスケジューラーが行うため、OpenAIクライアント側の再試行は無効にする
+        if self.max_retries is None:
+            self.max_retries = 0
+
+    def _call_scheduler(self):
+        return self.scheduler or get_scheduler()
+
+    def _estimate_tokens(self, messages):
+        prompt_tokens = sum(count_tokens(str(message.content or "")) for message in messages)
+        return prompt_tokens + (self.max_tokens or self.max_completion_tokens or DEFAULT_COMPLETION_TOKENS)
+
+    def invoke(self, messages):
+        invoke = super().invoke
+        estimated = self._estimate_tokens(messages)
+        response = self._call_scheduler().call(lambda: invoke(messages), estimated)
+        self._call_scheduler().settle(estimated, getattr(getattr(response, "usage", None), "total_tokens", None))
+        return response
+
+    async def ainvoke(self, messages):
+        ainvoke = super().ainvoke
+        estimated = self._estimate_tokens(messages)
+        response = await self._call_scheduler().acall(lambda: ainvoke(messages), estimated)
+        self._call_scheduler().settle(estimated, getattr(getattr(response, "usage", None), "total_tokens", None))
+        return response
+
+    def invoke_stream(self, messages):
+        invoke_stream = super().invoke_stream
+
+        def start_stream():
+            # 最初のチャンクを取得した時点でAPIリクエストが送信されるため、ここまでを再試行の対象にする
+            stream = invoke_stream(messages)
+            try:
+                first = next(stream)
+            except StopIteration:
+                return iter(())
+            return itertools.chain([first], stream)
+
+        yield from self._call_scheduler().call(start_stream, self._estimate_tokens(messages))
+
+    async def ainvoke_stream(self, messages):
+        ainvoke_stream = super().ainvoke_stream
+
+        async def start_stream():
+            stream = ainvoke_stream(messages)
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                return None, stream
+            return first, stream
+
+        first, stream = await self._call_scheduler().acall(start_stream, self._estimate_tokens(messages))
+        if first is None:
+            return
+        yield first
+        async for chunk in stream:
+            yield chunk
@@ -0,0 +1,322 @@
+import math
+import re
+
+# レポート生成エージェントに渡すコンテキストの組み立てと、保存時のプレースホルダー展開
+
+# データベースレコードの詳細表示に使用するフィールド順
+INCIDENT_FIELDS = [
+    "incident_number", "created_at", "status", "priority", "category", "subcategory",
+    "system_name", "module", "short_description", "description", "resolution",
+    "assigned_to", "updated_at", "error_code", "affected_version",
+]
+
+# 検索結果に含まれるインシデントのコンパクトな要約のフィールド（incident_summary.py）
+COMPACT_FIELDS = ["error_codes", "symptoms", "resolution_gist", "duplicate_count"]
+
+# 長文フィールド（予算超過時に最初に短縮される）
+LONG_FIELDS = ["description", "resolution"]
+
+# 要約レベルのレコードで残すフィールド
+SUMMARY_FIELDS = ["incident_number", "system_name", "module", "short_description", "error_code", "duplicate_count"]
+
+# 長文フィールドを短縮する際に残す先頭の文字数
+LONG_FIELD_HEAD_CHARS = 200
+
+# 関連度計算時のフィールドごとの重み
+FIELD_WEIGHTS = {
+    "error_code": 3.0,
+    "error_codes": 3.0,
+    "short_description": 2.0,
+    "symptoms": 1.5,
+    "system_name": 2.0,
+    "module": 2.0,
+    "description": 1.0,
+    "resolution": 1.0,
+    "resolution_gist": 1.0,
+}
+
+# Web検索結果のセクションごとの価値（値が小さいものから削除する）
+WEB_SECTION_VALUES = {
+    "追加リソース": 1,
+    "代替アプローチ": 2,
+    "引用部分": 3,
+    "実装例": 4,
+    "技術的詳細": 5,
+    "情報源の分析": 6,
+    "主要内容": 7,
+    "調査概要": 8,
+    "問題の根本原因分析": 9,
+    "推奨される対処方法": 10,
+    "まとめ": 11,
+}
+DEFAULT_WEB_SECTION_VALUE = 5
+
+# レポート本文に埋め込むプレースホルダー
+INCIDENT_PLACEHOLDER_PATTERN = re.compile(r"\{\{INCIDENT_DETAILS:([A-Za-z0-9_\-]+)\}\}")
+WEB_RESULTS_PLACEHOLDER = "{{WEB_RESULTS}}"
+
+_CJK_PATTERN = r"\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f"
+_TOKEN_PATTERN = re.compile(rf"[{_CJK_PATTERN}]|[A-Za-z0-9_]+|\S")
+_TERM_PATTERN = re.compile(rf"[{_CJK_PATTERN}]+|[A-Za-z0-9_\-\.]{{2,}}")
+
+
+def count_tokens(text):
+    """
+    テキストのトークン数をローカルで概算する。
+    日本語（かな・漢字）は1文字1トークン、英数字の連続は4文字ごとに1トークン、
+    その他の記号は1文字1トークンとして数える。
+
+    Args:
+        text (str): 対象テキスト
+
+    Returns:
+        int: 概算トークン数
+    """
+    if not text:
+        return 0
+    tokens = 0
+    for piece in _TOKEN_PATTERN.findall(text):
+        if piece[0].isascii() and (piece[0].isalnum() or piece[0] == "_"):
+            tokens += math.ceil(len(piece) / 4)
+        else:
+            tokens += 1
+    return tokens
+
+
+def extract_terms(query):
+    """問い合わせ文から関連度計算用の検索語（英数字の語と日本語のbi-gram）を抽出する"""
+    terms = set()
+    for chunk in _TERM_PATTERN.findall(query or ""):
+        if chunk[0].isascii():
+            terms.add(chunk.lower())
+        elif len(chunk) == 1:
+            terms.add(chunk)
+        else:
+            terms.update(chunk[i:i + 2] for i in range(len(chunk) - 1))
+    return terms
+
+
+def score_row(row, terms):
+    """検索語がレコードの各フィールドにどれだけ含まれるかで関連度（0〜1）を計算する"""
+    if not terms:
+        return 0.0
+    total = 0.0
+    for field, weight in FIELD_WEIGHTS.items():
+        value = str(row.get(field) or "").lower()
+        if not value:
+            continue
+        hits = sum(1 for term in terms if term in value)
+        total += weight * hits / len(terms)
+    return total / sum(FIELD_WEIGHTS.values())
+
+
+def rank_rows(rows, query):
+    """レコードを問い合わせとの関連度の高い順に並べ替え、(関連度, レコード) のリストを返す"""
+    terms = extract_terms(query)
+    scored = [(score_row(row, terms), index, row) for index, row in enumerate(rows)]
+    # 同点の場合は元の検索結果の順序を維持する
+    scored.sort(key=lambda item: (-item[0], item[1]))
+    return [(score, row) for score, _, row in scored]
+
+
+def _is_fence(line):
+    return line.strip().startswith("```")
+
+
+def strip_outer_fence(text):
+    """
+    全体が1つのコードブロック（```）で囲まれている場合は外側の囲みを外す。
+    Web検索エージェントは出力テンプレートごと ``` で囲んで保存することがあり、
+    そのままでは見出しがすべてコードブロック内とみなされるため。
+    """
+    lines = (text or "").strip().splitlines()
+    if len(lines) < 2 or not _is_fence(lines[0]) or lines[-1].strip() != "```":
+        return text
+    inner = lines[1:-1]
+    # 内側のコードブロックの開始・終了が対応していない場合は、外側の囲みではない
+    if sum(1 for line in inner if _is_fence(line)) % 2:
+        return text
+    return "\n".join(inner)
+
+
+def split_web_sections(web_briefing):
+    """Web検索結果のMarkdownを見出し単位のセクション [(見出し, 本文)] に分割する"""
+    sections = []
+    heading, lines = "", []
+    in_code = False
+    for line in strip_outer_fence(web_briefing or "").splitlines():
+        if _is_fence(line):
+            in_code = not in_code
+        if not in_code and re.match(r"^\s*#{1,6}\s", line):
+            if heading or any(l.strip() for l in lines):
+                sections.append((heading, "\n".join(lines)))
+            heading, lines = line.strip().lstrip("#").strip(), [line]
+        else:
+            lines.append(line)
+    if heading or any(l.strip() for l in lines):
+        sections.append((heading, "\n".join(lines)))
+    return sections
+
+
+def _web_section_value(heading):
+    for name, value in WEB_SECTION_VALUES.items():
+        if name in heading:
+            return value
+    return DEFAULT_WEB_SECTION_VALUE
+
+
+def _format_row(rank, score, row, level):
+    """レコードを指定の詳細度で整形する（0: 全文、1: 長文短縮、2: 要約のみ）"""
+    number = row.get("incident_number", "不明")
+    lines = [f"### {rank}. {number} (関連度 {score:.2f})"]
+    fields = SUMMARY_FIELDS if level >= 2 else [f for f in INCIDENT_FIELDS + COMPACT_FIELDS if f in row]
+    for field in fields:
+        if field == "incident_number" or field not in row:
+            continue
+        value = "" if row[field] is None else str(row[field])
+        if level == 1 and field in LONG_FIELDS and len(value) > LONG_FIELD_HEAD_CHARS:
+            value = value[:LONG_FIELD_HEAD_CHARS] + "…（以下省略）"
+        lines.append(f"- {field}: {value}")
+    return "\n".join(lines)
+
+
+# 省略の種類ごとの説明（レコードの詳細度 1〜3 と Web検索結果のセクション）
+_LEVEL_NOTES = {
+    1: f"description/resolution を先頭{LONG_FIELD_HEAD_CHARS}文字に短縮",
+    2: "要約フィールドのみ掲載",
+    3: "関連度が低いため除外",
+}
+
+
+def _omission_notes(ranked, levels, web_sections, web_kept):
+    """省略した内容を種類ごとに1行にまとめる（各レコードは現在の詳細度の行にのみ載る）"""
+    notes = []
+    headings = [heading or "（見出しなし）" for (heading, _), kept in zip(web_sections, web_kept) if not kept]
+    if headings:
+        notes.append(f"Web検索結果のセクションを省略: {', '.join(f'「{h}」' for h in headings)}")
+    for level, description in _LEVEL_NOTES.items():
+        numbers = [str(row.get("incident_number", "不明")) for (_, row), l in zip(ranked, levels) if l == level]
+        if numbers:
+            notes.append(f"{description}: {', '.join(numbers)}")
+    return notes
+
+
+def _truncate_tokens(text, token_budget, marker):
+    """テキストの末尾を削って marker を含めて token_budget 以内に収める"""
+    limit = max(token_budget - count_tokens(marker), 0)
+    tokens, end = 0, 0
+    for match in _TOKEN_PATTERN.finditer(text):
+        tokens += count_tokens(match.group())
+        if tokens > limit:
+            break
+        end = match.end()
+    return text[:end] + marker
+
+
+def _assemble(query, ranked, levels, web_sections, web_kept):
+    notes = _omission_notes(ranked, levels, web_sections, web_kept)
+    parts = ["## 問い合わせ内容", query or "(問い合わせ内容なし)", ""]
+    if ranked:
+        parts.append(f"## データベース検索結果（関連度順 {len(ranked)}件）")
+        for rank, ((score, row), level) in enumerate(zip(ranked, levels), start=1):
+            if level < 3:
+                parts.append(_format_row(rank, score, row, level))
+        parts.append("")
+    if web_sections:
+        parts.append("## Web検索結果")
+        parts.extend(body for (_, body), kept in zip(web_sections, web_kept) if kept)
+        parts.append("")
+    if notes:
+        parts.append("## 省略された情報")
+        parts.extend(f"- {note}" for note in notes)
+        parts.append("- 省略された内容はプレースホルダーを使ってレポートに完全な形で展開されます")
+    return "\n".join(parts).strip() + "\n"
+
+
+def pack_report_context(query, rows, web_briefing, token_budget):
+    """
+    問い合わせ内容・DB検索結果・Web検索結果をトークン予算内に収まるように組み立てる。
+    予算を超える場合は価値の低い情報から順に削る:
+    1. Web検索結果の重要度の低いセクション
+    2. 関連度の低いレコードの長文フィールド（description, resolution）の短縮
+    3. 関連度の低いレコードを要約のみに縮小
+    4. 関連度の低いレコードの除外
+    5. 最も関連度の高いレコードの長文フィールドの短縮、要約のみへの縮小
+    それでも超える場合は問い合わせ内容、最後にコンテキストの末尾を削り、予算を超えたことを明記する。
+    省略した内容は「省略された情報」セクションでモデルに伝える（レコードごとに現在の詳細度のみ）。
+
+    Args:
+        query (str): 元の問い合わせ内容
+        rows (list): DB検索結果のレコード（dict）のリスト
+        web_briefing (str): Web検索結果のMarkdown
+        token_budget (int): コンテキスト全体のトークン予算
+
+    Returns:
+        str: モデルに渡すコンテキスト文字列
+    """
+    ranked = rank_rows(rows or [], query)
+    levels = [0] * len(ranked)
+    web_sections = split_web_sections(web_briefing) if isinstance(web_briefing, str) else []
+    web_kept = [True] * len(web_sections)
+
+    # 削減手順を価値の低い順に並べる
+    steps = []
+    for index in sorted(range(len(web_sections)), key=lambda i: _web_section_value(web_sections[i][0])):
+        steps.append(("web", index, 0))
+    # 最も関連度の高いレコードは、他のレコードをすべて削った後に短縮する
+    low_to_high = list(range(len(ranked) - 1, 0, -1))
+    for level in (1, 2, 3):
+        steps.extend(("row", index, level) for index in low_to_high)
+    if ranked:
+        steps.extend([("row", 0, 1), ("row", 0, 2)])
+
+    context = _assemble(query, ranked, levels, web_sections, web_kept)
+    for kind, index, level in steps:
+        if count_tokens(context) <= token_budget:
+            break
+        if kind == "web":
+            web_kept[index] = False
+        else:
+            if levels[index] >= level:
+                continue
+            levels[index] = level
+        context = _assemble(query, ranked, levels, web_sections, web_kept)
+    # それでも超える場合は問い合わせ内容を短縮し、なお超える場合は末尾を削る
+    overflow = count_tokens(context) - token_budget
+    if overflow > 0 and query:
+        query = _truncate_tokens(query, count_tokens(query) - overflow, "…（トークン予算を超えたため以降を省略）")
+        context = _assemble(query, ranked, levels, web_sections, web_kept)
+    if count_tokens(context) > token_budget:
+        context = _truncate_tokens(context, token_budget, f"\n…（トークン予算 {token_budget} を超えたため以降を省略）\n")
+    return context
+
+
+def render_incident_details(row):
+    """レコードの全フィールドを省略せずにMarkdownの表として整形する"""
+    lines = ["| フィールド | 値 |", "|------------|-----|"]
+    fields = [f for f in INCIDENT_FIELDS if f in row] + [f for f in row if f not in INCIDENT_FIELDS]
+    for field in fields:
+        value = "" if row[field] is None else str(row[field])
+        value = value.replace("|", "\\|").replace("\r\n", "\n").replace("\n", "<br>")
+        lines.append(f"| {field} | {value} |")
+    return "\n".join(lines)
+
+
+def expand_report_placeholders(contents, rows, web_briefing):
+    """
+    レポート本文のプレースホルダーを完全なデータに置き換える。
+    - {{INCIDENT_DETAILS:INCxxxxx}} → 該当レコードの全フィールドの表（rows にない場合はその旨の注記）
+    - {{WEB_RESULTS}} → Web検索結果の全文
+    """
+    by_number = {str(row.get("incident_number")): row for row in rows or []}
+
+    def replace_incident(match):
+        row = by_number.get(match.group(1))
+        if row is None:
+            return f"（{match.group(1)} のレコードはデータベースに見つかりませんでした）"
+        return render_incident_details(row)
+
+    contents = INCIDENT_PLACEHOLDER_PATTERN.sub(replace_incident, contents)
+    if WEB_RESULTS_PLACEHOLDER in contents:
+        contents = contents.replace(WEB_RESULTS_PLACEHOLDER, web_briefing if isinstance(web_briefing, str) else "")
+    return contents
@@ -0,0 +1,276 @@
+import hashlib
+import os
+import re
+import sqlite3
+import sys
+import zlib
+from datetime import datetime
+
+# 生成したレポートを圧縮してSQLiteに保存し、日付・キーワード・インシデント番号・情報源で検索できるようにする
+
+REPORT_DB = "reports/reports.db"
+
+# 情報源（データベース検索結果 / Web検索結果）
+SOURCE_DB = "db"
+SOURCE_WEB = "web"
+SOURCES = (SOURCE_DB, SOURCE_WEB)
+
+INCIDENT_NUMBER_PATTERN = re.compile(r"\bINC\d+\b")
+REPORT_FILE_PATTERN = re.compile(r"^report_(\d{8})_(.+)\.md$")
+
+
+def connect(db_path=REPORT_DB):
+    """レポートストアに接続する（テーブルがなければ作成する）"""
+    directory = os.path.dirname(db_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript('''
+    CREATE TABLE IF NOT EXISTS reports (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        report_date TEXT NOT NULL,
+        created_at TIMESTAMP NOT NULL,
+        title TEXT,
+        source TEXT NOT NULL,
+        content_hash TEXT NOT NULL UNIQUE,
+        body_size INTEGER NOT NULL,
+        body BLOB NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS idx_reports_date ON reports (report_date);
+    CREATE INDEX IF NOT EXISTS idx_reports_source ON reports (source, report_date);
+
+    CREATE TABLE IF NOT EXISTS report_keywords (
+        keyword TEXT NOT NULL,
+        report_id INTEGER NOT NULL REFERENCES reports (id),
+        PRIMARY KEY (keyword, report_id)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS report_incidents (
+        incident_number TEXT NOT NULL,
+        report_id INTEGER NOT NULL REFERENCES reports (id),
+        PRIMARY KEY (incident_number, report_id)
+    ) WITHOUT ROWID;
+
+    CREATE TABLE IF NOT EXISTS report_tickets (
+        ticket_id TEXT PRIMARY KEY,
+        report_id INTEGER NOT NULL REFERENCES reports (id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_report_tickets_report ON report_tickets (report_id);
+    ''')
+    return conn
+
+
+def content_hash(body):
+    """重複判定に使用するレポート本文のハッシュ（前後の空白と改行コードの違いは無視する）"""
+    normalized = body.replace("\r\n", "\n").strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+def _report_title(body):
+    for line in body.splitlines():
+        if line.startswith("# "):
+            return line[2:].strip()
+    return None
+
+
+def _normalize_keywords(keywords):
+    if isinstance(keywords, str):
+        keywords = re.split(r"[,、]", keywords)
+    seen = []
+    for keyword in keywords:
+        keyword = keyword.strip()
+        if keyword and keyword not in seen:
+            seen.append(keyword)
+    return seen
+
+
+def find_duplicate(body, db_path=REPORT_DB):
+    """同じ内容のレポートが保存済みであればそのIDを返す。なければ None"""
+    conn = connect(db_path)
+    try:
+        row = conn.execute("SELECT id FROM reports WHERE content_hash = ?", (content_hash(body),)).fetchone()
+        return row["id"] if row else None
+    finally:
+        conn.close()
+
+
+def store_report(body, keywords, source, incident_numbers=None, report_date=None, ticket_id=None,
+                 db_path=REPORT_DB):
+    """
+    レポートを圧縮して保存する。同じ内容のレポートが既にある場合は新しく保存せず、
+    キーワードとインシデント番号の索引だけを追加する。
+
+    Args:
+        body (str): Markdown形式のレポート本文
+        keywords (list or str): 検索用キーワード（カンマ区切りの文字列も可）
+        source (str): 情報源（"db" または "web"）
+        incident_numbers (list): 引用したインシデント番号。省略時は本文から抽出する
+        report_date (str): レポートの日付（YYYYMMDD）。省略時は今日の日付
+        ticket_id (str): レポートを作成したチケットのID。指定した場合はチケットIDでも検索できる
+        db_path (str): レポートストアのパス
+
+    Returns:
+        tuple: (レポートID, 新規に保存した場合は True、重複していた場合は False)
+    """
+    if source not in SOURCES:
+        raise ValueError(f"source は {SOURCES} のいずれかを指定してください: {source}")
+    if incident_numbers is None:
+        incident_numbers = INCIDENT_NUMBER_PATTERN.findall(body)
+    now = datetime.now()
+    report_date = report_date or now.strftime("%Y%m%d")
+    digest = content_hash(body)
+
+    conn = connect(db_path)
+    try:
+        with conn:
+            row = conn.execute("SELECT id FROM reports WHERE content_hash = ?", (digest,)).fetchone()
+            if row:
+                report_id, created = row["id"], False
+            else:
+                encoded = body.encode("utf-8")
+                cursor = conn.execute(
+                    "INSERT INTO reports (report_date, created_at, title, source, content_hash, body_size, body) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (report_date, now.strftime("%Y-%m-%d %H:%M:%S"), _report_title(body), source, digest,
+                     len(encoded), zlib.compress(encoded, 9)),
+                )
+                report_id, created = cursor.lastrowid, True
+            conn.executemany(
+                "INSERT OR IGNORE INTO report_keywords (keyword, report_id) VALUES (?, ?)",
+                [(keyword, report_id) for keyword in _normalize_keywords(keywords)],
+            )
+            conn.executemany(
+                "INSERT OR IGNORE INTO report_incidents (incident_number, report_id) VALUES (?, ?)",
+                [(number, report_id) for number in sorted(set(incident_numbers))],
+            )
+            if ticket_id is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO report_tickets (ticket_id, report_id) VALUES (?, ?)",
+                    (str(ticket_id), report_id),
+                )
+        return report_id, created
+    finally:
+        conn.close()
+
+
+def find_reports(report_date=None, keyword=None, incident_number=None, source=None,
+                 date_from=None, date_to=None, ticket_id=None, limit=50, db_path=REPORT_DB):
+    """
+    条件に一致するレポートの一覧（本文を除くメタデータ）を新しい順に返す。
+
+    Args:
+        report_date (str): レポートの日付（YYYYMMDD）
+        keyword (str): 索引に登録されたキーワード（完全一致）
+        incident_number (str): 引用されたインシデント番号
+        source (str): 情報源（"db" または "web"）
+        date_from (str): 日付の下限（YYYYMMDD、この日を含む）
+        date_to (str): 日付の上限（YYYYMMDD、この日を含む）
+        ticket_id (str): レポートを作成したチケットのID
+        limit (int): 最大件数
+        db_path (str): レポートストアのパス
+
+    Returns:
+        list: レポートのメタデータ（dict）のリスト
+    """
+    conditions, params = [], []
+    if report_date:
+        conditions.append("r.report_date = ?")
+        params.append(report_date)
+    if date_from:
+        conditions.append("r.report_date >= ?")
+        params.append(date_from)
+    if date_to:
+        conditions.append("r.report_date <= ?")
+        params.append(date_to)
+    if source:
+        conditions.append("r.source = ?")
+        params.append(source)
+    if keyword:
+        conditions.append("r.id IN (SELECT report_id FROM report_keywords WHERE keyword = ?)")
+        params.append(keyword)
+    if incident_number:
+        conditions.append("r.id IN (SELECT report_id FROM report_incidents WHERE incident_number = ?)")
+        params.append(incident_number)
+    if ticket_id is not None:
+        conditions.append("r.id IN (SELECT report_id FROM report_tickets WHERE ticket_id = ?)")
+        params.append(str(ticket_id))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    conn = connect(db_path)
+    try:
+        rows = conn.execute(f'''
+        SELECT r.id, r.report_date, r.created_at, r.title, r.source, r.body_size,
+               (SELECT group_concat(keyword, ', ') FROM report_keywords WHERE report_id = r.id) AS keywords,
+               (SELECT group_concat(incident_number, ', ') FROM report_incidents WHERE report_id = r.id) AS incident_numbers
+        FROM reports r
+        {where}
+        ORDER BY r.report_date DESC, r.id DESC
+        LIMIT ?
+        ''', params + [limit]).fetchall()
+        return [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+
+def get_report(report_id, db_path=REPORT_DB):
+    """レポートのメタデータと本文を返す。存在しない場合は None"""
+    conn = connect(db_path)
+    try:
+        row = conn.execute("SELECT * FROM reports WHERE id = ?", (report_id,)).fetchone()
+        if row is None:
+            return None
+        report = dict(row)
+        report["body"] = zlib.decompress(report["body"]).decode("utf-8")
+        return report
+    finally:
+        conn.close()
+
+
+def export_report(report_id, file_path, db_path=REPORT_DB):
+    """レポートをMarkdownファイルとして書き出す"""
+    report = get_report(report_id, db_path)
+    if report is None:
+        raise KeyError(f"レポートが見つかりません: {report_id}")
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write(report["body"])
+    return file_path
+
+
+def import_markdown_reports(reports_dir, db_path=REPORT_DB):
+    """
+    reports フォルダの既存のMarkdownレポート（report_YYYYMMDD_キーワード.md）をレポートストアに取り込む。
+    インシデント番号を引用しているレポートはDB、それ以外はWebを情報源とみなす。
+
+    Returns:
+        tuple: (新規に取り込んだ件数, 重複としてスキップした件数)
+    """
+    imported = skipped = 0
+    with os.scandir(reports_dir) as entries:
+        for entry in entries:
+            match = REPORT_FILE_PATTERN.match(entry.name)
+            if not match or not entry.is_file():
+                continue
+            with open(entry.path, "r", encoding="utf-8", errors="replace") as f:
+                body = f.read()
+            incident_numbers = INCIDENT_NUMBER_PATTERN.findall(body)
+            _, created = store_report(
+                body,
+                [match.group(2)],
+                SOURCE_DB if incident_numbers else SOURCE_WEB,
+                incident_numbers=incident_numbers,
+                report_date=match.group(1),
+                db_path=db_path,
+            )
+            if created:
+                imported += 1
+            else:
+                skipped += 1
+    return imported, skipped
+
+
+if __name__ == "__main__":
+    reports_dir = sys.argv[1] if len(sys.argv) > 1 else "reports"
+    imported, skipped = import_markdown_reports(reports_dir)
+    print(f"{imported}件のレポートを {REPORT_DB} に取り込みました（重複 {skipped}件）。")
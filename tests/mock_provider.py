@@ -0,0 +1,59 @@
+from types import SimpleNamespace
+
+# スケジューラーのテスト用に、レート制限を実際に適用するモデルAPIのモック
+
+
+class FakeClock:
+    """sleep() で時刻が進む仮想時計"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += max(seconds, 0.0)
+
+
+class RateLimitError(Exception):
+    """OpenAI SDK の RateLimitError と同じく response.status_code / response.headers を持つ例外"""
+
+    def __init__(self, retry_after):
+        super().__init__("429 Too Many Requests")
+        self.response = SimpleNamespace(status_code=429, headers={"retry-after": f"{retry_after:g}"})
+
+
+class RateLimitedModel:
+    """
+    1分あたりのリクエスト数とトークン数の上限を超えると 429（Retry-After 付き）を返すモック。
+    OpenAI と同じく、上限は1分かけて一定速度で回復する（最大で1分間の上限まで溜まる）。
+    呼び出しは model(tokens) の形で行い、成功した場合は呼び出し時刻を返す。
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, clock):
+        self.limits = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.remaining = dict(self.limits)
+        self.clock = clock
+        self.updated = clock()
+        self.calls = []
+        self.rejected = []
+
+    def __call__(self, tokens):
+        now = self.clock()
+        for name, limit in self.limits.items():
+            self.remaining[name] = min(limit, self.remaining[name] + (now - self.updated) * limit / 60)
+        self.updated = now
+        needed = {"requests": 1, "tokens": tokens}
+        # 誤差の範囲の不足は許容する
+        shortage = [(needed[name] - self.remaining[name]) * 60 / self.limits[name]
+                    for name in self.limits if self.remaining[name] < needed[name] - 1e-6]
+        if shortage:
+            self.rejected.append(now)
+            raise RateLimitError(max(shortage))
+        for name in self.limits:
+            self.remaining[name] -= needed[name]
+        self.calls.append(now)
+        return now
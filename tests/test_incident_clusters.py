@@ -0,0 +1,82 @@
+import sqlite3
+
+from incident_clusters import collapse_rows, update_clusters
+from incident_shards import INCIDENT_COLUMNS, _create_incidents_table, insert_incidents, search_incidents
+
+SYSTEMS = ["SAP ERP", "Oracle EBS", "Salesforce"]
+
+
+def _incident(number, system_name, month, template):
+    incident = dict.fromkeys(INCIDENT_COLUMNS)
+    incident.update({
+        "incident_number": f"INC{number:05d}",
+        "created_at": f"2024-{month:02d}-01 09:00:00",
+        "updated_at": f"2024-{month:02d}-02 09:00:00",
+        "system_name": system_name,
+        "module": "FI-GL",
+        "error_code": f"E{number:04d}",
+    })
+    if template == "batch":
+        incident.update({
+            "short_description": f"{number}番目の夜間バッチ処理実行時にエラー発生",
+            "description": f"夜間バッチ処理を実行したところ、エラーコード E{number:04d} が表示されて処理が中断されました。"
+                           "再実行しても同じエラーが発生します。ログにはデータベース接続のタイムアウトが記録されています。",
+            "resolution": "原因はデータベース接続プールの枯渇でした。1. 接続プールの上限を引き上げる 2. バッチを再実行する",
+        })
+    else:
+        incident.update({
+            "short_description": f"請求書の印刷レイアウトが崩れる（{number}）",
+            "description": "請求書をPDFで出力すると明細行が2ページ目にずれて印刷されます。プレビューでは正しく表示されます。",
+            "resolution": "原因はプリンタードライバーの用紙設定でした。1. 用紙サイズをA4に変更する",
+        })
+    return incident
+
+
+def _incidents():
+    # 同じ内容のバッチエラーを、システム・月の異なる複数のシャードに分散させる
+    incidents = [_incident(i, SYSTEMS[i % 3], 1 + i % 4, "batch") for i in range(1, 9)]
+    incidents += [_incident(i, SYSTEMS[i % 3], 1 + i % 4, "print") for i in range(9, 12)]
+    return incidents
+
+
+def test_near_duplicates_are_collapsed_across_shards(tmp_path):
+    shard_dir = str(tmp_path / "shards")
+    manifest = insert_incidents(_incidents(), shard_dir)
+    assert len(manifest["shards"]) > 3
+
+    rows = search_incidents(["エラー"], limit=5, shard_dir=shard_dir)
+    assert len(rows) == 1
+    assert rows[0]["duplicate_count"] == 8
+
+    rows = search_incidents(["原因"], limit=5, shard_dir=shard_dir)
+    assert sorted(row["duplicate_count"] for row in rows) == [3, 8]
+
+
+def test_shard_clusters_match_single_database(tmp_path):
+    incidents = _incidents()
+    shard_dir = str(tmp_path / "shards")
+    insert_incidents(incidents, shard_dir)
+
+    conn = sqlite3.connect(str(tmp_path / "single.db"))
+    _create_incidents_table(conn)
+    conn.executemany(
+        f"INSERT INTO incidents ({', '.join(INCIDENT_COLUMNS)}) VALUES ({', '.join('?' for _ in INCIDENT_COLUMNS)})",
+        [tuple(incident[column] for column in INCIDENT_COLUMNS) for incident in incidents],
+    )
+    conn.commit()
+    update_clusters(conn)
+    single = conn.execute("SELECT incident_number, cluster_id FROM incident_clusters ORDER BY 1").fetchall()
+
+    index = sqlite3.connect(str(tmp_path / "shards" / "clusters.db"))
+    assert index.execute("SELECT incident_number, cluster_id FROM incident_clusters ORDER BY 1").fetchall() == single
+
+
+def test_collapse_rows_keeps_highest_ranked_row_per_cluster():
+    rows = [
+        {"incident_number": "INC00003", "cluster_id": "INC00001"},
+        {"incident_number": "INC00002", "cluster_id": "INC00002"},
+        {"incident_number": "INC00001", "cluster_id": "INC00001"},
+        {"incident_number": "INC00004", "cluster_id": None},
+    ]
+    collapsed = collapse_rows(rows, limit=2)
+    assert [row["incident_number"] for row in collapsed] == ["INC00003", "INC00002"]
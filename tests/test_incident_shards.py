@@ -0,0 +1,61 @@
+import os
+import sqlite3
+
+from incident_shards import INCIDENT_COLUMNS, fetch_incidents, insert_incidents, search_incidents, systems_in_keywords
+
+SYSTEMS = {"SAP ERP", "Oracle EBS", "Microsoft Dynamics 365", "Infor CloudSuite", "Salesforce"}
+
+
+def test_generic_keywords_do_not_select_a_system():
+    for keyword in ("Sales", "ERP", "Cloud", "Info", "Order Management"):
+        assert systems_in_keywords([keyword], SYSTEMS) == set()
+
+
+def test_full_names_and_aliases_select_the_system():
+    assert systems_in_keywords(["SAP ERP"], SYSTEMS) == {"SAP ERP"}
+    assert systems_in_keywords(["sap"], SYSTEMS) == {"SAP ERP"}
+    assert systems_in_keywords(["Dynamics 365 Sales"], SYSTEMS) == {"Microsoft Dynamics 365"}
+    assert systems_in_keywords(["Salesforce", "Infor"], SYSTEMS) == {"Salesforce", "Infor CloudSuite"}
+
+
+def test_alias_must_match_on_word_boundaries():
+    assert systems_in_keywords(["SAPPHIRE", "DEBS"], SYSTEMS) == set()
+
+
+def _incident(number, system_name, created_at, description):
+    incident = dict.fromkeys(INCIDENT_COLUMNS)
+    incident.update({
+        "incident_number": number,
+        "created_at": created_at,
+        "updated_at": created_at,
+        "system_name": system_name,
+        "short_description": description,
+        "description": description,
+    })
+    return incident
+
+
+def test_reinsert_with_new_shard_key_removes_the_old_copy(tmp_path):
+    shard_dir = str(tmp_path / "shards")
+    insert_incidents([
+        _incident("INC00001", "SAP ERP", "2024-01-10 09:00:00", "伝票の転記エラー"),
+        _incident("INC00002", "SAP ERP", "2024-01-11 09:00:00", "印刷の不具合"),
+    ], shard_dir)
+
+    # 作成日時を訂正して再登録すると、別の月のシャードに移動する
+    manifest = insert_incidents([_incident("INC00001", "SAP ERP", "2024-02-10 09:00:00", "伝票の転記エラー（訂正）")],
+                                shard_dir)
+
+    rows = fetch_incidents(["INC00001"], shard_dir)
+    assert [row["created_at"] for row in rows] == ["2024-02-10 09:00:00"]
+    assert {name: shard["count"] for name, shard in manifest["shards"].items()} == {
+        "sap_erp_202401": 1,
+        "sap_erp_202402": 1,
+    }
+    rows = search_incidents(["転記エラー"], shard_dir=shard_dir)
+    assert [row["short_description"] for row in rows] == ["伝票の転記エラー（訂正）"]
+
+    conn = sqlite3.connect(os.path.join(shard_dir, "sap_erp_202401.db"))
+    for table in ("incidents", "incident_summaries", "incident_clusters"):
+        assert conn.execute(f"SELECT incident_number FROM {table}").fetchall() == [("INC00002",)]
+    conn.close()
@@ -0,0 +1,107 @@
+import sqlite3
+
+import pytest
+
+import incident_summary
+from incident_shards import INCIDENT_COLUMNS, _create_incidents_table
+from incident_summary import extract_error_codes, refresh_incident_summaries
+
+
+def _incident(number, updated_at="2024-01-01 09:00:00", description="夜間バッチがタイムアウトで停止しました。"):
+    incident = dict.fromkeys(INCIDENT_COLUMNS)
+    incident.update({
+        "incident_number": number,
+        "updated_at": updated_at,
+        "short_description": "夜間バッチの停止",
+        "description": description,
+        "resolution": "原因はジョブの競合でした。\n1. ジョブの実行時刻をずらす",
+        "error_code": "BC100",
+    })
+    return incident
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    _create_incidents_table(conn)
+    yield conn
+    conn.close()
+
+
+def _insert(conn, *incidents):
+    conn.executemany(
+        f"INSERT OR REPLACE INTO incidents ({', '.join(INCIDENT_COLUMNS)}) "
+        f"VALUES ({', '.join('?' for _ in INCIDENT_COLUMNS)})",
+        [tuple(incident[column] for column in INCIDENT_COLUMNS) for incident in incidents],
+    )
+    conn.commit()
+
+
+def _summaries(conn):
+    return {number: symptoms for number, symptoms in conn.execute(
+        "SELECT incident_number, symptoms FROM incident_summaries")}
+
+
+def test_refresh_rebuilds_only_changed_incidents(conn, monkeypatch):
+    _insert(conn, _incident("INC00001"), _incident("INC00002"), _incident("INC00003"))
+    assert refresh_incident_summaries(conn) == 3
+    assert refresh_incident_summaries(conn) == 0
+
+    # updated_at が変わったインシデントだけを作成し直す
+    _insert(conn, _incident("INC00002", "2024-01-05 09:00:00", "画面がフリーズしました。"))
+    assert refresh_incident_summaries(conn) == 1
+    assert _summaries(conn)["INC00002"] == "画面がフリーズしました。"
+
+    # updated_at が同じまま内容だけ変わった場合は作成し直さない（force で作成し直せる）
+    _insert(conn, _incident("INC00003", description="帳票が出力されません。"))
+    assert refresh_incident_summaries(conn) == 0
+    assert refresh_incident_summaries(conn, ["INC00003"], force=True) == 1
+    assert _summaries(conn)["INC00003"] == "帳票が出力されません。"
+
+    # 要約の作成方法（SUMMARY_VERSION）が変わった場合はすべて作成し直す
+    monkeypatch.setattr(incident_summary, "SUMMARY_VERSION", incident_summary.SUMMARY_VERSION + 1)
+    assert refresh_incident_summaries(conn, ["INC00001"]) == 1
+    assert refresh_incident_summaries(conn) == 2
+    assert refresh_incident_summaries(conn) == 0
+
+
+def test_refresh_deletes_summaries_of_removed_incidents(conn):
+    _insert(conn, _incident("INC00001"), _incident("INC00002"))
+    refresh_incident_summaries(conn)
+    conn.execute("DELETE FROM incidents WHERE incident_number = 'INC00001'")
+    conn.commit()
+
+    assert refresh_incident_summaries(conn) == 0
+    assert list(_summaries(conn)) == ["INC00002"]
+
+
+def test_error_codes_from_error_code_field_and_named_errors():
+    assert extract_error_codes({
+        "error_code": "DBIF_RSQL_SQL_ERROR",
+        "short_description": "FAGL_FC_VALUATIONで外貨評価実行時にダンプが発生",
+        "description": "外貨評価プログラム（FAGL_FC_VALUATION）を実行したところ、DBIF_RSQL_SQL_ERRORというダンプが発生しました。",
+    }) == ["DBIF_RSQL_SQL_ERROR"]
+    assert extract_error_codes({
+        "error_code": None,
+        "description": "「BenefitAccrualCalculationFailedException: Failed to calculate」というエラーが発生",
+    }) == ["BenefitAccrualCalculationFailedException"]
+    assert extract_error_codes({"error_code": "ION-VAL-1022", "description": ""}) == ["ION-VAL-1022"]
+
+
+def test_error_codes_in_description_need_an_error_context():
+    assert extract_error_codes({
+        "error_code": "M7931",
+        "description": "3. 材料番号RAW-500（バッチ管理あり）を入力し、数量100kgを入力\n4. バッチ番号B2023001を指定\n"
+                       "するとエラーメッセージ「バッチB2023001に対するバッチシリアル番号が存在しません」が表示されます。",
+    }) == ["M7931"]
+    assert extract_error_codes({
+        "error_code": "CL123",
+        "description": "「BAPI_OBJCL_CREATE の実行中にエラーが発生しました」というエラーメッセージが表示されます。"
+                       "材料番号FG-1000、受注番号SO-123456 を入力しました。",
+    }) == ["CL123"]
+    assert extract_error_codes({
+        "error_code": "ORA-01555",
+        "short_description": "期間終了処理実行時に「ORA-01555: snapshot too old」エラーが発生",
+        "description": "続けてエラーコード ORA-30036 が表示され、再実行するとV7100というエラーになりました。"
+                       "ログには「MESSAGE_TYPE_X」ダンプも記録されています。",
+    }) == ["ORA-01555", "ORA-30036", "V7100", "MESSAGE_TYPE_X"]
@@ -0,0 +1,98 @@
+import threading
+import time
+
+import pytest
+
+from mock_provider import FakeClock, RateLimitedModel, RateLimitError
+from model_scheduler import PRIORITY_HIGH, PRIORITY_LOW, ModelCallScheduler
+
+
+def _scheduler(clock, **kwargs):
+    return ModelCallScheduler(clock=clock, sleep=clock.sleep, **kwargs)
+
+
+def test_requests_per_minute_pacing():
+    clock = FakeClock()
+    scheduler = _scheduler(clock, requests_per_minute=60, tokens_per_minute=100000)
+    model = RateLimitedModel(60, 100000, clock)
+    for _ in range(70):
+        scheduler.call(lambda: model(1), 1)
+    # 最初の60件はバケットの容量内で即時に、残りの10件は1秒に1件ずつ送信される
+    assert model.calls[59] == 0
+    assert model.calls[-1] == pytest.approx(10, abs=0.01)
+    assert model.rejected == []
+
+
+def test_tokens_per_minute_pacing():
+    clock = FakeClock()
+    scheduler = _scheduler(clock, requests_per_minute=1000, tokens_per_minute=1000)
+    model = RateLimitedModel(1000, 1000, clock)
+    for _ in range(4):
+        scheduler.call(lambda: model(500), 500)
+    assert model.calls == pytest.approx([0, 0, 30, 60], abs=0.01)
+    assert model.rejected == []
+
+
+def test_429_pauses_and_drains_buckets():
+    clock = FakeClock()
+    scheduler = _scheduler(clock, requests_per_minute=600, tokens_per_minute=100000, base_delay=0.0)
+    failures = [RateLimitError(5)]
+
+    def call():
+        if failures:
+            raise failures.pop()
+        return clock()
+
+    sent_at = scheduler.call(call, 1)
+    assert sent_at >= 5
+    # 停止の解除時点でバケットは空で、以降は補充速度（10件/秒）で再開する
+    assert scheduler.requests.wait_time(1) > 0
+    scheduler.call(lambda: None, 1)
+    assert clock() - sent_at == pytest.approx(0.1, abs=0.01)
+
+
+def test_scheduler_recovers_from_provider_limits():
+    clock = FakeClock()
+    # スケジューラーの設定がプロバイダーの上限より緩い場合も、429 に従って再試行し全件成功する
+    scheduler = _scheduler(clock, requests_per_minute=600, tokens_per_minute=100000, max_retries=10)
+    model = RateLimitedModel(10, 100000, clock)
+    for _ in range(25):
+        scheduler.call(lambda: model(1), 1)
+    assert len(model.calls) == 25
+    assert model.rejected
+    assert scheduler._paused_until >= model.rejected[-1]
+
+
+def test_non_retryable_error_is_raised():
+    clock = FakeClock()
+    scheduler = _scheduler(clock)
+
+    def call():
+        raise ValueError("bad request")
+
+    with pytest.raises(ValueError):
+        scheduler.call(call, 1)
+    assert clock.sleeps == []
+
+
+def test_high_priority_jumps_the_queue():
+    scheduler = ModelCallScheduler(requests_per_minute=600, tokens_per_minute=100000)
+    scheduler.requests.tokens = 0
+    order = []
+
+    def worker(name, priority):
+        scheduler.call(lambda: order.append(name), 1, priority=priority)
+
+    threads = []
+    for name, priority in [("low-1", PRIORITY_LOW), ("low-2", PRIORITY_LOW), ("low-3", PRIORITY_LOW),
+                           ("high", PRIORITY_HIGH)]:
+        thread = threading.Thread(target=worker, args=(name, priority))
+        thread.start()
+        threads.append(thread)
+        # 待ち行列に登録されるまで待つ
+        while len(scheduler._waiting) < len(threads):
+            time.sleep(0.001)
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert order == ["high", "low-1", "low-2", "low-3"]
@@ -0,0 +1,74 @@
+from report_context import count_tokens, expand_report_placeholders, pack_report_context, split_web_sections
+
+
+def _rows(count):
+    return [
+        {
+            "incident_number": f"INC{i:05d}",
+            "system_name": "SAP ERP",
+            "short_description": "給与計算バッチでエラー",
+            "description": "説明" * 300,
+            "resolution": "解決" * 300,
+            "error_code": "F5003",
+        }
+        for i in range(count)
+    ]
+
+
+FENCED_BRIEFING = "\n".join([
+    "```markdown",
+    "# 調査概要",
+    "概要" * 50,
+    "## 追加リソース",
+    "資料" * 200,
+    "## まとめ",
+    "まとめの文章",
+    "```",
+])
+
+
+def test_split_web_sections_strips_outer_fence():
+    headings = [heading for heading, _ in split_web_sections(FENCED_BRIEFING)]
+    assert headings == ["調査概要", "追加リソース", "まとめ"]
+
+
+def test_split_web_sections_keeps_inner_code_blocks():
+    briefing = "# 実装例\n```python\n# コメント\nprint(1)\n```\n# まとめ\n文章"
+    headings = [heading for heading, _ in split_web_sections(briefing)]
+    assert headings == ["実装例", "まとめ"]
+
+
+def test_fenced_briefing_drops_lowest_value_section_first():
+    context = pack_report_context("問い合わせ", [], FENCED_BRIEFING, 300)
+    assert "まとめの文章" in context
+    assert "資料資料" not in context
+    assert "「追加リソース」" in context
+
+
+def test_each_row_has_a_single_note():
+    context = pack_report_context("給与計算でエラー", _rows(8), "", 800)
+    notes = context.split("## 省略された情報")[1]
+    for number in (f"INC{i:05d}" for i in range(8)):
+        assert notes.count(number) == 1
+    assert count_tokens(context) <= 800
+
+
+def test_budget_is_enforced_with_overflow_marker():
+    for budget in (800, 300, 150):
+        context = pack_report_context("給与計算でエラー" * 40, _rows(8), FENCED_BRIEFING, budget)
+        assert count_tokens(context) <= budget
+    assert "トークン予算を超えたため以降を省略" in context
+
+
+def test_context_within_budget_is_unchanged():
+    context = pack_report_context("給与計算でエラー", _rows(1), "", 100000)
+    assert "省略された情報" not in context
+    assert "説明" * 300 in context
+
+
+def test_expand_report_placeholders():
+    contents = "{{INCIDENT_DETAILS:INC00000}}\n{{INCIDENT_DETAILS:INC99999}}\n{{WEB_RESULTS}}"
+    expanded = expand_report_placeholders(contents, _rows(1), "# まとめ\nWeb検索結果")
+    assert "| resolution | " + "解決" * 300 + " |" in expanded
+    assert "（INC99999 のレコードはデータベースに見つかりませんでした）" in expanded
+    assert expanded.endswith("# まとめ\nWeb検索結果")
@@ -0,0 +1,106 @@
+import sqlite3
+import zlib
+
+import pytest
+
+from report_store import (
+    SOURCE_DB, SOURCE_WEB, export_report, find_duplicate, find_reports, get_report, import_markdown_reports,
+    store_report,
+)
+
+BODY = "# 給与計算バッチのエラー\n\n## 原因\nINC00001 と同じ接続プールの枯渇です。\n"
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "reports" / "reports.db")
+
+
+def test_same_content_is_stored_once(db_path):
+    report_id, created = store_report(BODY, "給与計算", SOURCE_DB, db_path=db_path)
+    assert created
+
+    # 改行コードと前後の空白だけが異なる本文は同じレポートとみなし、索引だけを追加する
+    duplicate = "\n  " + BODY.replace("\n", "\r\n") + "\r\n\r\n"
+    assert find_duplicate(duplicate, db_path=db_path) == report_id
+    assert store_report(duplicate, "バッチ", SOURCE_DB, incident_numbers=["INC00002"], db_path=db_path) == (
+        report_id, False)
+
+    reports = find_reports(db_path=db_path)
+    assert len(reports) == 1
+    assert sorted(reports[0]["keywords"].split(", ")) == ["バッチ", "給与計算"]
+    assert sorted(reports[0]["incident_numbers"].split(", ")) == ["INC00001", "INC00002"]
+
+    _, created = store_report(BODY + "追記", "給与計算", SOURCE_DB, db_path=db_path)
+    assert created
+
+
+def test_find_reports_filters(db_path):
+    first, _ = store_report("# A\nINC00001", "SAP, 給与計算", SOURCE_DB, report_date="20240110", ticket_id="T-1",
+                            db_path=db_path)
+    second, _ = store_report("# B\nWebの情報", ["給与計算"], SOURCE_WEB, report_date="20240215", ticket_id="T-2",
+                             db_path=db_path)
+    third, _ = store_report("# C", "Oracle", SOURCE_DB, incident_numbers=["INC00003"], report_date="20240301",
+                            db_path=db_path)
+
+    def ids(**filters):
+        return [report["id"] for report in find_reports(db_path=db_path, **filters)]
+
+    assert ids() == [third, second, first]
+    assert ids(report_date="20240215") == [second]
+    assert ids(date_from="20240201") == [third, second]
+    assert ids(date_to="20240215") == [second, first]
+    assert ids(date_from="20240111", date_to="20240228") == [second]
+    assert ids(keyword="給与計算") == [second, first]
+    # キーワードは完全一致で検索する
+    assert ids(keyword="給与") == []
+    assert ids(incident_number="INC00001") == [first]
+    assert ids(incident_number="INC00003") == [third]
+    assert ids(source=SOURCE_WEB) == [second]
+    assert ids(source=SOURCE_DB, keyword="給与計算") == [first]
+    assert ids(ticket_id="T-2") == [second]
+    assert ids(limit=1) == [third]
+
+
+def test_body_is_compressed_and_restored(db_path, tmp_path):
+    body = BODY + "明細\n" * 500
+    report_id, _ = store_report(body, "給与計算", SOURCE_DB, db_path=db_path)
+
+    conn = sqlite3.connect(db_path)
+    stored, body_size = conn.execute("SELECT body, body_size FROM reports WHERE id = ?", (report_id,)).fetchone()
+    conn.close()
+    assert body_size == len(body.encode("utf-8"))
+    assert len(stored) < body_size
+    assert zlib.decompress(stored).decode("utf-8") == body
+
+    report = get_report(report_id, db_path=db_path)
+    assert report["body"] == body
+    assert report["title"] == "給与計算バッチのエラー"
+    assert get_report(report_id + 1, db_path=db_path) is None
+
+    path = export_report(report_id, str(tmp_path / "export.md"), db_path=db_path)
+    with open(path, encoding="utf-8") as f:
+        assert f.read() == body
+
+
+def test_import_markdown_reports(db_path, tmp_path):
+    reports_dir = tmp_path / "markdown"
+    reports_dir.mkdir()
+    (reports_dir / "report_20240110_給与計算.md").write_text(BODY, encoding="utf-8")
+    (reports_dir / "report_20240111_Web調査.md").write_text("# Web調査\nベンダーの情報\n", encoding="utf-8")
+    (reports_dir / "report_20240112_再出力.md").write_text(BODY + "\n", encoding="utf-8")
+    (reports_dir / "notes.md").write_text("# メモ\nINC00009\n", encoding="utf-8")
+
+    assert import_markdown_reports(str(reports_dir), db_path=db_path) == (2, 1)
+    assert import_markdown_reports(str(reports_dir), db_path=db_path) == (0, 3)
+
+    # ファイルの列挙順は環境によって異なるため、重複した2件のどちらの日付で保存されたかは問わない
+    reports = {report["source"]: report for report in find_reports(db_path=db_path)}
+    assert sorted(reports) == [SOURCE_DB, SOURCE_WEB]
+    assert reports[SOURCE_DB]["report_date"] in ("20240110", "20240112")
+    assert reports[SOURCE_DB]["incident_numbers"] == "INC00001"
+    assert sorted(reports[SOURCE_DB]["keywords"].split(", ")) == ["再出力", "給与計算"]
+    assert reports[SOURCE_WEB]["report_date"] == "20240111"
+    assert reports[SOURCE_WEB]["title"] == "Web調査"
+    assert reports[SOURCE_WEB]["incident_numbers"] is None
+    assert find_reports(incident_number="INC00009", db_path=db_path) == []
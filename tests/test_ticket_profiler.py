@@ -0,0 +1,88 @@
+import json
+import pstats
+import threading
+import tracemalloc
+
+import ticket_profiler
+from ticket_profiler import profile_ticket, should_profile
+
+
+def _work():
+    return json.loads(json.dumps([{"value": i} for i in range(2000)]))
+
+
+def test_should_profile_samples_by_ticket_id_hash():
+    ticket_ids = [f"T-{i}" for i in range(10000)]
+    sampled = [ticket_id for ticket_id in ticket_ids if should_profile(ticket_id, 0.1)]
+    assert 800 < len(sampled) < 1200
+    # 同じチケットIDは何度判定しても同じ結果になる
+    assert sampled == [ticket_id for ticket_id in ticket_ids if should_profile(ticket_id, 0.1)]
+    assert not any(should_profile(ticket_id, 0) for ticket_id in ticket_ids[:100])
+    assert all(should_profile(ticket_id, 1) for ticket_id in ticket_ids[:100])
+
+
+def test_sampling_rate_defaults_to_module_setting(monkeypatch):
+    monkeypatch.setattr(ticket_profiler, "SAMPLE_RATE", 0)
+    with profile_ticket("T-1") as result:
+        pass
+    assert not result.enabled
+    assert result.summary_path is None
+
+
+def test_profile_files_are_written(tmp_path):
+    with profile_ticket("T/1", enabled=True, profile_dir=str(tmp_path), top_n=5) as result:
+        _work()
+
+    assert result.enabled and result.error is None
+    assert result.summary_path.startswith(str(tmp_path / "T_1_"))
+    stats = pstats.Stats(result.cpu_profile_path)
+    assert any(function == "loads" for _, _, function in stats.stats)
+    assert tracemalloc.Snapshot.load(result.memory_snapshot_path).traces is not None
+    with open(result.summary_path, encoding="utf-8") as f:
+        summary = f.read()
+    assert "チケットID: T/1" in summary
+    assert "JSON:" in summary
+    assert "## 累積時間の上位5件" in summary
+    assert not tracemalloc.is_tracing()
+
+
+def test_overlapping_tickets_profile_only_the_first(tmp_path):
+    first_started, second_done = threading.Event(), threading.Event()
+    results = {}
+
+    def first():
+        with profile_ticket("A", enabled=True, profile_dir=str(tmp_path)) as result:
+            first_started.set()
+            second_done.wait(timeout=5)
+            _work()
+        results["A"] = result
+
+    def second():
+        first_started.wait(timeout=5)
+        with profile_ticket("B", enabled=True, profile_dir=str(tmp_path)) as result:
+            _work()
+        results["B"] = result
+        second_done.set()
+
+    threads = [threading.Thread(target=first), threading.Thread(target=second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+
+    assert results["A"].summary_path is not None and results["A"].error is None
+    assert not results["B"].enabled and results["B"].summary_path is None
+    assert not tracemalloc.is_tracing()
+
+
+def test_save_error_does_not_fail_the_ticket(tmp_path):
+    not_a_directory = tmp_path / "file"
+    not_a_directory.write_text("")
+    with profile_ticket("T-1", enabled=True, profile_dir=str(not_a_directory)) as result:
+        value = _work()
+    assert len(value) == 2000
+    assert result.error is not None and result.summary_path is None
+    # 失敗した後も次のチケットを記録できる
+    with profile_ticket("T-2", enabled=True, profile_dir=str(tmp_path)) as result:
+        pass
+    assert result.summary_path is not None
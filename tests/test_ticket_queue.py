@@ -0,0 +1,126 @@
+import pytest
+
+import ticket_queue
+from ticket_queue import (
+    MAX_RETRIES, collect_results, connect, dead_letter_queue, enqueue_ticket, message_priority, result_queue,
+    run_worker,
+)
+
+
+@pytest.fixture
+def connection():
+    # メモリ上のブローカーの状態はプロセス内で共有されるため、テストごとにキューを空にする
+    with connect("memory://") as connection:
+        for queue in (ticket_queue.ticket_queue, result_queue, dead_letter_queue):
+            queue(connection.default_channel).declare()
+            queue(connection.default_channel).purge()
+        yield connection
+
+
+def _answer(ticket_id, question, priority):
+    return {"answer": f"回答: {question}", "report": None}
+
+
+def _drain(connection, queue):
+    messages = []
+    with connection.SimpleQueue(queue) as simple_queue:
+        while True:
+            try:
+                message = simple_queue.get(block=True, timeout=0.1)
+            except simple_queue.Empty:
+                return messages
+            messages.append(message.payload)
+            message.ack()
+
+
+def test_ticket_is_processed_and_result_is_keyed_by_ticket_id(connection):
+    ticket_id = enqueue_ticket(connection, "SAP ERPでF5003エラー", ticket_id="T-1")
+    assert run_worker(connection, _answer, limit=1, timeout=1) == 1
+    results = collect_results(connection, store_reports=False)
+    assert results[ticket_id]["status"] == "done"
+    assert results[ticket_id]["answer"] == "回答: SAP ERPでF5003エラー"
+
+
+def test_failed_ticket_is_retried(connection):
+    attempts = []
+
+    def flaky(ticket_id, question, priority):
+        attempts.append(ticket_id)
+        if len(attempts) == 1:
+            raise RuntimeError("一時的なエラー")
+        return _answer(ticket_id, question, priority)
+
+    ticket_id = enqueue_ticket(connection, "問い合わせ")
+    run_worker(connection, flaky, limit=2, timeout=1)
+    assert attempts == [ticket_id, ticket_id]
+    assert collect_results(connection, store_reports=False)[ticket_id]["status"] == "done"
+
+
+def test_ticket_moves_to_dead_letter_queue_after_max_retries(connection):
+    def broken(ticket_id, question, priority):
+        raise RuntimeError("処理できません")
+
+    ticket_id = enqueue_ticket(connection, "問い合わせ")
+    assert run_worker(connection, broken, timeout=1) == MAX_RETRIES + 1
+
+    dead = _drain(connection, dead_letter_queue)
+    assert [ticket["ticket_id"] for ticket in dead] == [ticket_id]
+    assert dead[0]["retries"] == MAX_RETRIES + 1
+    assert "RuntimeError: 処理できません" in dead[0]["last_error"]
+    result = collect_results(connection, store_reports=False)[ticket_id]
+    assert result["status"] == "failed"
+
+
+def test_ticket_is_not_acked_when_worker_crashes(connection):
+    def crash(ticket_id, question, priority):
+        raise KeyboardInterrupt
+
+    ticket_id = enqueue_ticket(connection, "問い合わせ")
+    with pytest.raises(KeyboardInterrupt):
+        run_worker(connection, crash, limit=1, timeout=1)
+
+    channel = connection.default_channel
+    assert len(channel.qos._delivered) == 1
+    # ブローカーが接続の切断を検知して、未確認のメッセージを再配信した状態にする
+    channel.qos.restore_unacked()
+    assert run_worker(connection, _answer, limit=1, timeout=1) == 1
+    assert collect_results(connection, store_reports=False)[ticket_id]["status"] == "done"
+
+
+def test_priority_is_not_honored_by_memory_transport(connection):
+    # メモリ上のトランスポートは優先度に対応していないため、登録順に処理される
+    order = []
+
+    def record(ticket_id, question, priority):
+        order.append(priority)
+        return _answer(ticket_id, question, priority)
+
+    enqueue_ticket(connection, "低優先度の問い合わせ", priority="低")
+    enqueue_ticket(connection, "高優先度の問い合わせ", priority="高")
+    run_worker(connection, record, limit=2, timeout=1)
+    assert order == ["低", "高"]
+
+
+def test_message_priority_is_reversed_for_redis(connection):
+    assert message_priority(connection, "高") == 9
+
+    class RedisConnection:
+        class transport:
+            driver_type = "redis"
+
+    assert message_priority(RedisConnection, "高") == 0
+    assert message_priority(RedisConnection, "低") == 8
+    assert message_priority(connection, "不明") is None
+
+
+def test_profile_flag_is_passed_to_handler(connection):
+    received = {}
+
+    def handler(ticket_id, question, priority, profile=None):
+        received[ticket_id] = profile
+        return _answer(ticket_id, question, priority)
+
+    enqueue_ticket(connection, "問い合わせ", ticket_id="T-1", profile=True)
+    enqueue_ticket(connection, "問い合わせ", ticket_id="T-2")
+    run_worker(connection, handler, limit=2, timeout=1)
+    assert received == {"T-1": True, "T-2": None}
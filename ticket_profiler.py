@@ -0,0 +1,214 @@
+import cProfile
+import hashlib
+import io
+import logging
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+# 問い合わせ（チケット）1件の処理のCPUプロファイルとメモリ割り当て（tracemalloc）を記録する
+# 指定したチケットだけ、または本番のトラフィックの一部だけをサンプリングして記録できる
+
+# プロファイルの保存先（レポートストアと同じ reports ディレクトリ）
+PROFILE_DIR = "reports/profiles"
+
+# 明示的に指定しなかったチケットをプロファイルする割合（0.0 〜 1.0、既定は記録しない）
+SAMPLE_RATE = float(os.environ.get("IT_SUPPORT_PROFILE_SAMPLE_RATE", "0"))
+
+# 要約に載せる上位の件数
+TOP_N = 25
+
+# tracemalloc で記録するスタックフレームの深さ
+TRACEMALLOC_FRAMES = 10
+
+logger = logging.getLogger(__name__)
+
+# cProfile と tracemalloc はプロセス全体で1つしか有効にできないため、同時に記録するチケットは1件のみとする
+_profile_lock = threading.Lock()
+
+# 処理時間の内訳を集計する分類（ファイル名または関数名に含まれる文字列、先に一致したものを採用）
+PROFILE_CATEGORIES = [
+    ("ファイル読み込み", ("read_file_with_fallback_encoding", "codecs.py", "encodings/")),
+    ("JSON", ("json/",)),
+    ("SQLite", ("sqlite3", "sqlalchemy/", "incident_shards.py", "report_store.py")),
+    ("プロンプト組み立て", ("report_context.py", "incident_summary.py", "incident_clusters.py")),
+    ("HTTP通信", ("openai/", "httpx/", "httpcore/", "ssl.py", "socket.py", "exa_py/")),
+    ("agno", ("agno/",)),
+]
+
+
+def should_profile(ticket_id=None, sample_rate=None):
+    """
+    チケットをサンプリングの対象にするかを返す。
+    チケットIDがある場合はIDのハッシュで判定するため、再試行でも同じチケットは同じ結果になる。
+    """
+    sample_rate = SAMPLE_RATE if sample_rate is None else sample_rate
+    if sample_rate <= 0:
+        return False
+    if sample_rate >= 1:
+        return True
+    if ticket_id is None:
+        return random.random() < sample_rate
+    digest = hashlib.sha1(str(ticket_id).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64 < sample_rate
+
+
+def _categorize(file_name, function_name):
+    for category, patterns in PROFILE_CATEGORIES:
+        if any(pattern in file_name or pattern in function_name for pattern in patterns):
+            return category
+    return "その他"
+
+
+def category_breakdown(stats):
+    """関数ごとの処理時間（tottime）を分類ごとに合計し、(分類, 秒数) の降順のリストで返す"""
+    totals = {}
+    for (file_name, _, function_name), (_, _, tottime, _, _) in stats.stats.items():
+        category = _categorize(file_name.replace(os.sep, "/"), function_name)
+        totals[category] = totals.get(category, 0.0) + tottime
+    return sorted(totals.items(), key=lambda item: item[1], reverse=True)
+
+
+def format_summary(ticket_id, elapsed, profiler, snapshot, peak_bytes, top_n=TOP_N):
+    """CPUプロファイルとメモリのスナップショットから上位 top_n 件の要約（テキスト）を作成する"""
+    stats = pstats.Stats(profiler)
+    lines = [
+        f"チケットID: {ticket_id}",
+        f"処理時間: {elapsed:.3f} 秒",
+        f"メモリ使用量のピーク: {peak_bytes / 1024 / 1024:.1f} MiB",
+        "",
+        "## 処理時間の内訳（関数自身の処理時間の合計）",
+    ]
+    lines.extend(f"{category}: {seconds:.3f} 秒" for category, seconds in category_breakdown(stats))
+
+    for title, sort_key in (("累積時間", pstats.SortKey.CUMULATIVE), ("関数自身の処理時間", pstats.SortKey.TIME)):
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).strip_dirs().sort_stats(sort_key).print_stats(top_n)
+        lines.extend(["", f"## {title}の上位{top_n}件", stream.getvalue().strip()])
+
+    lines.extend(["", f"## メモリ割り当ての上位{top_n}件（処理終了時点で残っているもの）"])
+    lines.extend(str(statistic) for statistic in snapshot.statistics("lineno")[:top_n])
+    return "\n".join(lines) + "\n"
+
+
+class TicketProfile:
+    """プロファイルの記録結果（記録しなかった場合は enabled が False）"""
+
+    def __init__(self, ticket_id, enabled):
+        self.ticket_id = ticket_id
+        self.enabled = enabled
+        self.cpu_profile_path = None
+        self.memory_snapshot_path = None
+        self.summary_path = None
+        # 記録に失敗した場合のエラー（チケットの処理自体は失敗させない）
+        self.error = None
+
+
+@contextmanager
+def profile_ticket(ticket_id=None, enabled=None, profile_dir=PROFILE_DIR, sample_rate=None, top_n=TOP_N):
+    """
+    このコンテキスト内の処理のCPUプロファイルとメモリ割り当てを記録し、profile_dir に保存する。
+    - {チケットID}_{日時}.prof: cProfile の結果（python -m pstats や snakeviz で確認できる）
+    - {チケットID}_{日時}.tracemalloc: tracemalloc のスナップショット（tracemalloc.Snapshot.load で読み込める）
+    - {チケットID}_{日時}.txt: 処理時間の内訳と、処理時間・メモリ割り当ての上位 top_n 件の要約
+
+    cProfile はコンテキストに入ったスレッドの処理のみを記録する。
+    別のチケットを記録中の場合や、他のプロファイラーが有効な場合は記録しない（enabled が False になる）。
+    記録・保存に失敗してもコンテキスト内の処理は失敗させず、エラーをログに出力して error に設定する。
+
+    Args:
+        ticket_id (str): チケットID（ファイル名とサンプリングの判定に使用する）
+        enabled (bool): True/False で記録するかを指定する。None の場合は sample_rate の割合でサンプリングする
+        profile_dir (str): 保存先のディレクトリ
+        sample_rate (float): サンプリングの割合。省略時は SAMPLE_RATE
+        top_n (int): 要約に載せる上位の件数
+
+    Yields:
+        TicketProfile: 記録結果（コンテキストを抜けた後に保存先のパスが設定される）
+    """
+    if enabled is None:
+        enabled = should_profile(ticket_id, sample_rate)
+    result = TicketProfile(ticket_id, enabled)
+    if enabled and not _profile_lock.acquire(blocking=False):
+        logger.info("別のチケットのプロファイルを記録中のため、チケット %s は記録しません", ticket_id)
+        result.enabled = False
+    if not result.enabled:
+        yield result
+        return
+
+    try:
+        profiler, started_tracemalloc = _start_profiling()
+    except Exception as e:
+        # 他のプロファイラー（デバッガーなど）が有効な場合、Python 3.12 以降の cProfile は有効にできない
+        _profile_lock.release()
+        logger.warning("チケット %s のプロファイルを開始できませんでした: %s", ticket_id, e)
+        result.enabled, result.error = False, f"{type(e).__name__}: {e}"
+        yield result
+        return
+
+    started = time.perf_counter()
+    try:
+        yield result
+    finally:
+        try:
+            profiler.disable()
+            _save_profile(result, profile_dir, time.perf_counter() - started, profiler, top_n)
+        except Exception as e:
+            logger.exception("チケット %s のプロファイルを保存できませんでした", ticket_id)
+            result.error = f"{type(e).__name__}: {e}"
+        finally:
+            if started_tracemalloc and tracemalloc.is_tracing():
+                tracemalloc.stop()
+            _profile_lock.release()
+
+
+def _start_profiling():
+    """cProfile と tracemalloc を開始し、(プロファイラー, tracemalloc をこの関数で開始したか) を返す"""
+    # 既に tracemalloc が有効な場合（PYTHONTRACEMALLOC など）はそのまま使い、終了時も停止しない
+    started_tracemalloc = not tracemalloc.is_tracing()
+    if started_tracemalloc:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+    else:
+        tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except Exception:
+        if started_tracemalloc:
+            tracemalloc.stop()
+        raise
+    return profiler, started_tracemalloc
+
+
+def _save_profile(result, profile_dir, elapsed, profiler, top_n):
+    snapshot = tracemalloc.take_snapshot()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+
+    os.makedirs(profile_dir, exist_ok=True)
+    name = re.sub(r"[^0-9A-Za-z_\-]+", "_", str(result.ticket_id or "ticket"))
+    base = os.path.join(profile_dir, f"{name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}")
+    profiler.dump_stats(base + ".prof")
+    snapshot.dump(base + ".tracemalloc")
+    with open(base + ".txt", "w", encoding="utf-8") as f:
+        f.write(format_summary(result.ticket_id, elapsed, profiler, snapshot, peak_bytes, top_n))
+    result.cpu_profile_path = base + ".prof"
+    result.memory_snapshot_path = base + ".tracemalloc"
+    result.summary_path = base + ".txt"
+
+
+if __name__ == "__main__":
+    import sys
+
+    # 保存済みの .prof ファイルの要約を表示する（python ticket_profiler.py reports/profiles/xxx.prof）
+    for path in sys.argv[1:]:
+        stats = pstats.Stats(path)
+        print(f"# {path}")
+        for category, seconds in category_breakdown(stats):
+            print(f"{category}: {seconds:.3f} 秒")
+        stats.strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(TOP_N)